@@ -0,0 +1,123 @@
+"""
+学習データの水増し (data augmentation)
+
+ScribbleArea で描かれた数字は、MNIST よりも線が太く、中心に寄せられている。
+学習時にもそれに近い入力を与えるために、バッチ単位で次の変換を行う。
+
+- 線を太くする (ペンの太さを真似る)
+- 少しだけ回転する
+- キャンバスと同じように、バウンディングボックスの中心に寄せる
+- 少しだけ平行移動する
+
+どの変換も、バッチ全体を numpy の配列としてまとめて処理する。
+処理速度は次のコマンドで確認できる。
+
+    python augmentation.py
+"""
+import time
+
+import numpy as np
+
+from image_processing import center_digit
+
+default_max_degrees = 12.0
+default_max_shift = 2
+default_max_dilation = 1
+
+
+def dilate(images, iterations=1):
+    """
+    3x3 の最大値フィルタで線を太くする。
+
+    :param images: shape=(N, H, W) の配列
+    """
+    for _ in range(iterations):
+        height, width = images.shape[1:]
+        padded = np.pad(images, ((0, 0), (1, 1), (1, 1)), mode='constant')
+        out = padded[:, 1:height + 1, 1:width + 1].copy()
+        for dy in range(3):
+            for dx in range(3):
+                np.maximum(out, padded[:, dy:dy + height, dx:dx + width], out=out)
+        images = out
+    return images
+
+
+def random_dilate(images, random, max_dilation=default_max_dilation):
+    """画像ごとに 0 から max_dilation 回の範囲で、ランダムに線を太くする。"""
+    iterations = random.randint(0, max_dilation + 1, size=len(images))
+    out = images
+    dilated = images
+    for i in range(1, max_dilation + 1):
+        dilated = dilate(dilated)
+        out = np.where((iterations == i)[:, None, None], dilated, out)
+    return out
+
+
+def affine(images, degrees, shift_y, shift_x):
+    """
+    画像ごとに中心を軸に回転し、平行移動する。最近傍補間を使うので画素値は変わらない。
+
+    :param images: shape=(N, H, W) の配列
+    :param degrees: shape=(N,) の回転角 (度)
+    :param shift_y: shape=(N,) の縦方向の移動量 (画素)
+    :param shift_x: shape=(N,) の横方向の移動量 (画素)
+    """
+    n, height, width = images.shape
+    theta = np.deg2rad(degrees)[:, None, None]
+    cos = np.cos(theta)
+    sin = np.sin(theta)
+    cy = (height - 1) / 2
+    cx = (width - 1) / 2
+    # 出力の各画素に対応する、入力の画素の位置を逆変換で求める
+    y = np.arange(height)[None, :, None] - cy - shift_y[:, None, None]
+    x = np.arange(width)[None, None, :] - cx - shift_x[:, None, None]
+    src_y = np.rint(cos * y - sin * x + cy).astype(np.intp)
+    src_x = np.rint(sin * y + cos * x + cx).astype(np.intp)
+    valid = (0 <= src_y) & (src_y < height) & (0 <= src_x) & (src_x < width)
+    np.clip(src_y, 0, height - 1, out=src_y)
+    np.clip(src_x, 0, width - 1, out=src_x)
+    out = images[np.arange(n)[:, None, None], src_y, src_x]
+    out *= valid
+    return out
+
+
+def augment_batch(images, random,
+                  max_degrees=default_max_degrees,
+                  max_shift=default_max_shift,
+                  max_dilation=default_max_dilation):
+    """
+    バッチを水増しする。
+
+    :param images: shape=(N, 28, 28, 1) の配列 (0-255)
+    :param random: np.random.RandomState
+    :return: shape=(N, 28, 28, 1) の float32 の配列
+    """
+    n = len(images)
+    x = images.reshape(n, 28, 28).astype(np.float32)
+    x = random_dilate(x, random, max_dilation)
+    zeros = np.zeros(n)
+    x = affine(x, random.uniform(-max_degrees, max_degrees, size=n), zeros, zeros)
+    x = center_digit(x)
+    x = affine(x, zeros,
+               random.randint(-max_shift, max_shift + 1, size=n),
+               random.randint(-max_shift, max_shift + 1, size=n))
+    return x.reshape(n, 28, 28, 1)
+
+
+def benchmark(batch_size=1000, repeat=20):
+    """augment_batch の処理速度 (画像/秒) を測る"""
+    import mnist_dataset
+    random = np.random.RandomState(0)
+    if mnist_dataset.exists():
+        images = np.asarray(mnist_dataset.load().X_train[:batch_size])
+    else:
+        images = (random.rand(batch_size, 28, 28, 1) > 0.8) * 255.0
+    augment_batch(images, random)
+    begin = time.perf_counter()
+    for _ in range(repeat):
+        augment_batch(images, random)
+    return batch_size * repeat / (time.perf_counter() - begin)
+
+
+if __name__ == '__main__':
+    print("augmentation: {:.0f} images/s".format(benchmark()))
@@ -0,0 +1,61 @@
+import math
+
+import numpy as np
+from keras.utils import Sequence
+
+from augmentation import augment_batch
+
+
+class MnistSequence(Sequence):
+    """
+    保存してあるデータセットから、バッチを１つずつ取り出す Sequence
+
+    学習データ全体をコピーせずに、バッチごとに float32 へ変換する。
+    fit_generator の workers, max_queue_size を指定すれば、バッチの作成は
+    バックグラウンドのスレッドで行われ、先読みの数も制限される。
+    """
+    def __init__(self, x, y, batch_size, shuffle=True, seed=None):
+        self.x = x
+        self.y = y
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self._random = np.random.RandomState(seed)
+        self._order = np.arange(len(x))
+        if self.shuffle:
+            self._random.shuffle(self._order)
+
+    def __len__(self):
+        return int(math.ceil(len(self.x) / self.batch_size))
+
+    def __getitem__(self, index):
+        indices = self._order[index * self.batch_size:(index + 1) * self.batch_size]
+        # メモリマップから読むときに、なるべく順番に読めるように並べ替える
+        indices = np.sort(indices)
+        x = self.x[indices].astype(np.float32)
+        y = np.asarray(self.y[indices])
+        return x, y
+
+    def on_epoch_end(self):
+        if self.shuffle:
+            self._random.shuffle(self._order)
+
+
+class AugmentedSequence(MnistSequence):
+    """
+    水増ししたバッチを返す Sequence
+
+    バッチごとに乱数の種を決めるので、ワーカーのプロセスで作っても結果は再現できる。
+    """
+    def __init__(self, x, y, batch_size, shuffle=True, seed=None):
+        super(AugmentedSequence, self).__init__(x, y, batch_size, shuffle, seed)
+        self._seed = self._random.randint(2 ** 31)
+        self._epoch = 0
+
+    def __getitem__(self, index):
+        x, y = super(AugmentedSequence, self).__getitem__(index)
+        random = np.random.RandomState((self._seed + self._epoch * len(self) + index) % 2 ** 32)
+        return augment_batch(x, random), y
+
+    def on_epoch_end(self):
+        super(AugmentedSequence, self).on_epoch_end()
+        self._epoch += 1
@@ -0,0 +1,280 @@
+"""
+性能のベンチマーク
+
+ディスプレイがなくても動くように、Qt は offscreen で起動する。
+結果は JSON で保存し、ベースラインと比べて遅くなった項目があれば報告する。
+
+    python benchmark.py                   # 計測して benchmark_result.json に保存し、ベースラインと比較
+    python benchmark.py --save-baseline   # 計測結果を benchmark_baseline.json に保存
+    python benchmark.py --only predict_single,train
+
+レイテンシは平均よりも p50/p95/p99 を重視する。
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+
+import numpy as np
+
+default_result_path = './benchmark_result.json'
+default_baseline_path = './benchmark_baseline.json'
+# ベースラインよりこの割合以上遅くなったら、性能の低下とみなす
+default_tolerance = 0.2
+# 学習のベンチマークが書くチェックポイント
+default_checkpoint_path = './checkpoints/benchmark_latest.npz'
+
+
+def percentiles(seconds):
+    seconds = np.asarray(seconds)
+    return {"kind": "latency",
+            "n": len(seconds),
+            "mean": float(seconds.mean()),
+            "p50": float(np.percentile(seconds, 50)),
+            "p95": float(np.percentile(seconds, 95)),
+            "p99": float(np.percentile(seconds, 99))}
+
+
+def throughput(samples_per_second, **extra):
+    result = {"kind": "throughput", "samples_per_second": float(samples_per_second)}
+    result.update(extra)
+    return result
+
+
+def measure(func, repeat, warmup=3):
+    for _ in range(warmup):
+        func()
+    seconds = []
+    for _ in range(repeat):
+        begin = time.perf_counter()
+        func()
+        seconds.append(time.perf_counter() - begin)
+    return percentiles(seconds)
+
+
+def bench_preprocess(core, repeat):
+    os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+    from PyQt5.QtCore import Qt, QPoint
+    from PyQt5.QtGui import QPainter, QPen
+    from PyQt5.QtWidgets import QApplication
+    from hand_writing_widget import BarGraph, ScribbleArea
+
+    app = QApplication.instance() or QApplication(sys.argv)
+    area = ScribbleArea(BarGraph(), core)
+    area.resize(400, 400)
+    area.resizeImage(area.image, area.size())
+    area.clearImage()
+    painter = QPainter(area.image)
+    painter.setPen(QPen(Qt.black, 32, Qt.SolidLine, Qt.RoundCap, Qt.RoundJoin))
+    painter.drawLine(QPoint(200, 60), QPoint(180, 340))
+    painter.end()
+    result = measure(area.getProcessedImage, repeat)
+    area.inference.kill()
+    return result
+
+
+def bench_predict_single(core, repeat):
+    # キャッシュに当たらないように、予測のたびに入力を変える
+    images = np.random.RandomState(0).randint(0, 256, size=(repeat + 3, 1, 28, 28, 1))
+    images = images.astype(np.float32)
+    it = iter(images)
+    return measure(lambda: core.predict_batch(next(it)), repeat)
+
+
+def bench_predict_backend(core, repeat, backend):
+    """inference_backend を切り替えて bench_predict_single を行う"""
+    core.set_inference_backend(backend)
+    try:
+        return bench_predict_single(core, repeat)
+    finally:
+        core.set_inference_backend("keras")
+
+
+def bench_predict_batch(core, repeat, batch_size=1000):
+    images = np.asarray(core.X_test[:batch_size], dtype=np.float32)
+    result = measure(lambda: core.predict_batch(images), repeat)
+    result["batch_size"] = batch_size
+    result["samples_per_second"] = batch_size / result["p50"]
+    return result
+
+
+def bench_train(core, num_samples):
+    X_train, Y_train = core.X_train, core.Y_train
+    # GUI の再開用のチェックポイントを上書きしない
+    core.checkpoint_path = default_checkpoint_path
+    core.X_train, core.Y_train = X_train[:num_samples], Y_train[:num_samples]
+    try:
+        report = core.train(epochs=1, verbose=0)
+    finally:
+        core.X_train, core.Y_train = X_train, Y_train
+    return throughput(report["samples_per_second"],
+                      num_samples=num_samples,
+                      batch_size=report["batch_size"],
+                      seconds=report["seconds"])
+
+
+def bench_report_evaluation(core, repeat):
+    def run():
+        # 同じ重みの評価結果はキャッシュされるので、毎回評価し直す
+        core.clear_evaluation_cache()
+        return core.report_evaluation()
+
+    return measure(run, repeat, warmup=1)
+
+
+def bench_load_model(core, repeat):
+    """モデルファイルを読み込み、最初の予測ができるようになるまでの時間"""
+    from mnist_core import default_model_path
+    seconds = []
+    for _ in range(repeat):
+        core.load(default_model_path)
+        seconds.append(core.last_load_seconds)
+    return percentiles(seconds)
+
+
+def bench_startup(repeat):
+    """
+    新しいプロセスで MnistCore を作り、最初の予測が返るまでの時間
+
+    スレッド数は計測しないので、thread_profile.json があればその設定、なければ既定の設定で計る。
+    """
+    code = ("import numpy as np; from mnist_core import MnistCore; "
+            "MnistCore().predict(np.zeros((1, 28, 28, 1), dtype=np.float32))")
+    seconds = []
+    for _ in range(repeat):
+        begin = time.perf_counter()
+        subprocess.check_call([sys.executable, "-c", code],
+                              stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        seconds.append(time.perf_counter() - begin)
+    return percentiles(seconds)
+
+
+def _editor_model(units):
+    from model_creator import ModelCreator
+    creator = ModelCreator()
+    creator.add_conv2d(15, 3, 3)
+    creator.add_max_pool2d(2, 2)
+    creator.add_conv2d(15, 3, 3)
+    creator.add_max_pool2d(2, 2)
+    creator.add_batch_normalization()
+    creator.add_dense(units)
+    creator.add_dropout("0.5")
+    creator.add_dense(10)
+    creator.add_compile()
+    return creator
+
+
+def bench_build_model(repeat):
+    """
+    ModelCreator.get_model の時間
+
+    :return: 毎回違う構造を作る場合 (cold) と、同じ構造を作り直す場合 (repeated)
+    """
+    creators = iter([_editor_model(200 + i) for i in range(repeat + 1)])
+    cold = measure(lambda: next(creators).get_model(), repeat, warmup=1)
+    repeated = measure(_editor_model(200).get_model, repeat, warmup=1)
+    return cold, repeated
+
+
+def run_benchmarks(names, args):
+    from one_line_info import global_one_line_info
+    global_one_line_info.set_destination(lambda text: None)
+
+    results = {}
+    if "startup" in names:
+        results["startup"] = bench_startup(args.startup_repeat)
+    if "build_model" in names:
+        results["build_model_cold"], results["build_model_repeated"] = \
+            bench_build_model(args.repeat // 10 or 1)
+
+    if names & {"preprocess", "predict_single", "predict_numpy", "predict_batch", "train",
+                "report_evaluation", "load_model"}:
+        from mnist_core import MnistCore
+
+        class QuietCore(MnistCore):
+            def log(self, text):
+                pass
+
+        core = QuietCore()
+        if "preprocess" in names:
+            results["preprocess"] = bench_preprocess(core, args.repeat)
+        if "predict_single" in names:
+            results["predict_single"] = bench_predict_single(core, args.repeat)
+        if "predict_numpy" in names:
+            results["predict_numpy"] = bench_predict_backend(core, args.repeat, "numpy")
+        if "predict_batch" in names:
+            results["predict_batch"] = bench_predict_batch(core, args.repeat // 10 or 1)
+        if "report_evaluation" in names:
+            results["report_evaluation"] = bench_report_evaluation(core, args.eval_repeat)
+        if "load_model" in names:
+            results["load_model"] = bench_load_model(core, args.eval_repeat)
+        if "train" in names:
+            results["train"] = bench_train(core, args.train_samples)
+    return results
+
+
+def compare(results, baseline, tolerance):
+    """
+    ベースラインと比べて遅くなった項目を返す。
+
+    :return: [(項目名, 指標, ベースラインの値, 今回の値), ...]
+    """
+    regressions = []
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        base = baseline[name]
+        if result["kind"] == "latency":
+            for key in ("p50", "p95", "p99"):
+                if result[key] > base[key] * (1 + tolerance):
+                    regressions.append((name, key, base[key], result[key]))
+        else:
+            key = "samples_per_second"
+            if result[key] < base[key] * (1 - tolerance):
+                regressions.append((name, key, base[key], result[key]))
+    return regressions
+
+
+all_benchmarks = ("preprocess", "predict_single", "predict_numpy", "predict_batch", "train",
+                  "report_evaluation", "startup", "build_model", "load_model")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="MNIST GUI の性能を計測する")
+    parser.add_argument("--only", help="計測する項目 (カンマ区切り): " + ",".join(all_benchmarks))
+    parser.add_argument("--repeat", type=int, default=200)
+    parser.add_argument("--eval-repeat", type=int, default=5)
+    parser.add_argument("--startup-repeat", type=int, default=3)
+    parser.add_argument("--train-samples", type=int, default=10000)
+    parser.add_argument("--output", default=default_result_path)
+    parser.add_argument("--baseline", default=default_baseline_path)
+    parser.add_argument("--save-baseline", action="store_true",
+                        help="計測結果をベースラインとして保存する")
+    parser.add_argument("--tolerance", type=float, default=default_tolerance)
+    args = parser.parse_args(argv)
+
+    names = set(all_benchmarks if args.only is None else args.only.split(","))
+    unknown = names - set(all_benchmarks)
+    if unknown:
+        parser.error("unknown benchmark: " + ",".join(sorted(unknown)))
+
+    results = run_benchmarks(names, args)
+    output = args.baseline if args.save_baseline else args.output
+    with open(output, "w") as f:
+        json.dump(results, f, indent=2, sort_keys=True)
+    print(json.dumps(results, indent=2, sort_keys=True))
+
+    if args.save_baseline or not os.path.exists(args.baseline):
+        return 0
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    regressions = compare(results, baseline, args.tolerance)
+    for name, key, base, value in regressions:
+        print("REGRESSION {} {}: {:.6g} -> {:.6g}".format(name, key, base, value))
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
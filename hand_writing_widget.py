@@ -3,7 +3,9 @@ from PyQt5.QtGui import *
 from PyQt5.QtWidgets import *
 
 import numpy as np
-import matplotlib.pyplot as plt
+
+from image_processing import lightness, center_digit
+from inference_worker import InferenceWorker
 
 
 
@@ -56,45 +58,41 @@ class ScribbleArea(QWidget):
         self.lastPoint = QPoint()
         self.barOutput = bar_output
         self.model = model
+        # 予測は別スレッドで行い、結果だけを棒グラフに反映する
+        self.inference = InferenceWorker(model)
+        self.inference.result_signal.connect(self.barOutput.setValues)
+        self.inference.start()
 
     def getProcessedImage(self):
         self.resizeImage(self.image, self.size())
         scaled_image = self.image.smoothScaled(28, 28)
+        if scaled_image.format() != QImage.Format_RGB32:
+            scaled_image = scaled_image.convertToFormat(QImage.Format_RGB32)
         height = scaled_image.height()
         width = scaled_image.width()
-        black_set_x = []
-        black_set_y = []
-        image_array = np.zeros((height, width))
-        for y in range(height):
-            for x in range(width):
-                image_array[y][x] = 255 - scaled_image.pixelColor(x, y).lightness()
-                if image_array[y][x] >= 254:
-                    black_set_y.append(y)
-                    black_set_x.append(x)
-        if (len(black_set_x) is not 0) or (len(black_set_y) is not 0):
-            mid_x = (max(black_set_x) + min(black_set_x)) // 2
-            mid_y = (max(black_set_y) + min(black_set_y)) // 2
-        else:
-            mid_x = 0
-            mid_y = 0
-
-        translated_image = np.zeros((height, width))
-        for y in range(height):
-            for x in range(width):
-                y_ = y - mid_y + height // 2
-                x_ = x - mid_x + width // 2
-                if 0 <= x_ < 28 and 0 <= y_ < 28:
-                    translated_image[y_][x_] = image_array[y][x]
+        # QImage のメモリをコピーせずに numpy の配列として参照する
+        bits = scaled_image.constBits()
+        bits.setsize(scaled_image.byteCount())
+        bgra = np.frombuffer(bits, dtype=np.uint8)\
+            .reshape(height, scaled_image.bytesPerLine())[:, :width * 4]\
+            .reshape(1, height, width, 4)
+        image_array = 255 - lightness(bgra).astype(np.float32)
+        translated_image = center_digit(image_array)
         return translated_image.reshape((1, 28, 28, 1))
 
     def outputAcc(self):
-        image_array = self.getProcessedImage()
-        y = self.model.predict(image_array)
-        self.barOutput.setValues(y)
-        # for i in range(10):
-        #     print("{}: {:.4f}".format(i, y[i]))
+        """最後に描かれた画像で認識をやり直す。GUI スレッド以外からも呼べる。"""
+        self.inference.refresh()
+
+    def requestPrediction(self):
+        # ストロークの途中の再描画は、予測モードに従って間引く
+        final = not self.scribbling
+        if final or self.inference.accepts_intermediate():
+            self.inference.submit(self.getProcessedImage(), final)
 
     def showImage(self):
+        # matplotlib は読み込みに時間がかかるので、使うときに読み込む
+        import matplotlib.pyplot as plt
         image_array = self.getProcessedImage().reshape(28, 28)
         plt.imshow(image_array, cmap='gray', vmin=0, vmax=255)
         plt.pause(0.01)
@@ -114,6 +112,7 @@ class ScribbleArea(QWidget):
         if event.button() == Qt.LeftButton:
             self.lastPoint = event.pos()
             self.scribbling = True
+            self.inference.begin_stroke()
 
     def mouseMoveEvent(self, event):
         if (event.buttons() & Qt.LeftButton) and self.scribbling:
@@ -128,7 +127,7 @@ class ScribbleArea(QWidget):
         painter = QPainter(self)
         dirtyRect = event.rect()
         painter.drawImage(dirtyRect, self.image, dirtyRect)
-        self.outputAcc()
+        self.requestPrediction()
 
     def resizeEvent(self, event):
         if self.width() > self.image.width() or self.height() > self.image.height():
@@ -0,0 +1,63 @@
+import numpy as np
+
+# この値以上の画素を、数字の一部 (黒) とみなす
+black_threshold = 254
+
+
+def _make_lightness_table():
+    # QColor.lightness() の計算 (16bit に拡張し、倍精度で HSL に変換してから丸める) を
+    # (最大値, 最小値) のすべての組み合わせについて事前に計算しておく
+    c = np.arange(256) * 257 / 65535
+    l16 = np.floor(0.5 * (c[:, None] + c[None, :]) * 65535 + 0.5).astype(np.int64)
+    return ((l16 * 2 + 257) // 514).astype(np.uint8)
+
+
+_lightness_table = _make_lightness_table()
+
+
+def lightness(bgra):
+    """
+    QImage.Format_RGB32 の画素 (B, G, R, A の順) から、
+    QColor.lightness() と同じ値を計算する。
+
+    :param bgra: shape=(..., 4) の uint8 配列
+    :return: shape=(...) の uint8 配列
+    """
+    b, g, r = bgra[..., 0], bgra[..., 1], bgra[..., 2]
+    return _lightness_table[np.maximum(np.maximum(b, g), r),
+                            np.minimum(np.minimum(b, g), r)]
+
+
+def center_digit(images, out=None):
+    """
+    黒い画素のバウンディングボックスの中心が、画像の中心にくるように平行移動する。
+
+    :param images: shape=(N, H, W) の配列
+    :param out: 出力先。shape=(N, H, W)。None の場合は新しく確保する。
+    :return: 平行移動した画像。shape=(N, H, W)
+    """
+    n, height, width = images.shape
+    if out is None:
+        out = np.empty(images.shape, dtype=images.dtype)
+    black = images >= black_threshold
+    rows = black.any(axis=2)
+    cols = black.any(axis=1)
+    has_black = rows.any(axis=1)
+    # 黒い画素がない場合は (0, 0) を中心とみなす (元の実装と同じ挙動)
+    top = np.where(has_black, rows.argmax(axis=1), 0)
+    bottom = np.where(has_black, height - 1 - rows[:, ::-1].argmax(axis=1), 0)
+    left = np.where(has_black, cols.argmax(axis=1), 0)
+    right = np.where(has_black, width - 1 - cols[:, ::-1].argmax(axis=1), 0)
+    shift_y = height // 2 - (top + bottom) // 2
+    shift_x = width // 2 - (left + right) // 2
+    # 出力の各画素に対応する、入力の画素の位置
+    src_y = np.arange(height) - shift_y[:, None]
+    src_x = np.arange(width) - shift_x[:, None]
+    valid_y = (0 <= src_y) & (src_y < height)
+    valid_x = (0 <= src_x) & (src_x < width)
+    np.clip(src_y, 0, height - 1, out=src_y)
+    np.clip(src_x, 0, width - 1, out=src_x)
+    gathered = images[np.arange(n)[:, None, None], src_y[:, :, None], src_x[:, None, :]]
+    valid = valid_y[:, :, None] & valid_x[:, None, :]
+    np.multiply(gathered, valid, out=out, casting='unsafe')
+    return out
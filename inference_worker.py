@@ -0,0 +1,119 @@
+import threading
+import time
+
+from PyQt5.QtCore import QObject, pyqtSignal
+
+# 描画中の予測のモード
+PREDICT_LIVE = 'live'              # 描画のたびに予測する
+PREDICT_THROTTLED = 'throttled'    # 最大 rate_hz 回/秒 で予測する
+PREDICT_STROKE_END = 'stroke_end'  # ストロークを書き終えたときだけ予測する
+
+
+class InferenceWorker(threading.Thread, QObject):
+    """
+    手書き数字の認識を、GUI スレッドとは別のスレッドで実行するクラス
+
+    予測の要求が溜まった場合は、最新の要求以外を捨てる。
+    予測結果は result_signal で GUI スレッドに送る。
+    """
+    result_signal = pyqtSignal(object)
+
+    def __init__(self, model):
+        threading.Thread.__init__(self)
+        QObject.__init__(self)
+        self.daemon = True
+        self.model = model
+
+        self.mode = PREDICT_LIVE
+        self.rate_hz = 10.0
+        # １ストロークあたりの描画中の予測回数の上限。0 なら上限なし
+        self.max_predictions_per_stroke = 0
+
+        self._cond = threading.Condition()
+        self._pending = None
+        self._last_image = None
+        self._last_time = 0.0
+        self._stroke_count = 0
+        self._exit = False
+        self.num_predicted = 0
+        self.num_dropped = 0
+
+    def set_mode(self, mode, rate_hz=None, max_predictions_per_stroke=None):
+        if mode not in (PREDICT_LIVE, PREDICT_THROTTLED, PREDICT_STROKE_END):
+            raise RuntimeError("予測モード {} はサポートしていません。".format(mode))
+        with self._cond:
+            self.mode = mode
+            if rate_hz is not None:
+                if rate_hz <= 0:
+                    raise RuntimeError("予測の頻度は正の値を指定してください。")
+                self.rate_hz = rate_hz
+            if max_predictions_per_stroke is not None:
+                self.max_predictions_per_stroke = max_predictions_per_stroke
+
+    def begin_stroke(self):
+        with self._cond:
+            self._stroke_count = 0
+
+    def accepts_intermediate(self):
+        """描画中の予測の要求を受け付けるかどうか"""
+        if self.mode == PREDICT_STROKE_END:
+            return False
+        return not self._stroke_limit_reached()
+
+    def _stroke_limit_reached(self):
+        return 0 < self.max_predictions_per_stroke <= self._stroke_count
+
+    def submit(self, image, final=True):
+        """
+        予測を要求する。
+
+        :param image: shape=(1, 28, 28, 1) の画像
+        :param final: False の場合は描画中の要求として、モードと上限に従って間引く
+        """
+        with self._cond:
+            if self._pending is not None:
+                self.num_dropped += 1
+            self._pending = (image, final)
+            self._last_image = image
+            self._cond.notify()
+
+    def refresh(self):
+        """最後に要求された画像で、もう一度予測する。どのスレッドからでも呼べる。"""
+        with self._cond:
+            if self._last_image is None or self._pending is not None:
+                return
+            self._pending = (self._last_image, True)
+            self._cond.notify()
+
+    def kill(self):
+        with self._cond:
+            self._exit = True
+            self._cond.notify()
+
+    def run(self):
+        while True:
+            with self._cond:
+                while self._pending is None and not self._exit:
+                    self._cond.wait()
+                if self._exit:
+                    break
+                image, final = self._pending
+                if not final:
+                    if self.mode == PREDICT_STROKE_END or self._stroke_limit_reached():
+                        self._pending = None
+                        self.num_dropped += 1
+                        continue
+                    if self.mode == PREDICT_THROTTLED:
+                        wait = self._last_time + 1.0 / self.rate_hz - time.perf_counter()
+                        if wait > 0:
+                            # 待っている間に新しい要求が来たら、そちらを処理する
+                            self._cond.wait(wait)
+                            continue
+                    self._stroke_count += 1
+                self._pending = None
+
+            y = self.model.predict(image)
+            self._last_time = time.perf_counter()
+            self.num_predicted += 1
+            if y is not None:
+                self.result_signal.emit(y)
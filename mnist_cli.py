@@ -0,0 +1,193 @@
+"""
+GUI なしで学習、評価、予測を行うコマンド
+
+    python -m mnist_cli train --epochs 3 --batch-size 500 --output trained.hdf5
+    python -m mnist_cli train --architecture arch.json --epochs 1
+    python -m mnist_cli train --epochs 50 --time-budget 120 --target-f1 0.98
+    python -m mnist_cli eval --model model.hdf5
+    python -m mnist_cli predict --model model.hdf5 images.npy
+    python -m mnist_cli export --model model.hdf5 --output model.npz
+    python -m mnist_cli export --model model.hdf5 --output model_int8.npz --int8
+    python -m mnist_cli predict --engine model.npz images.npy   # TensorFlow を使わない
+    python -m mnist_cli quantize-report --model model.hdf5
+    python -m mnist_cli tune-threads --model model.hdf5
+
+結果は時間の計測結果とともに JSON で標準出力に出力する。
+ログは標準エラー出力に出力する。
+"""
+import argparse
+import json
+import sys
+import time
+
+import numpy as np
+
+from one_line_info import global_one_line_info
+
+# GUI の再開用のチェックポイントを上書きしないように、別のファイルに書く
+default_checkpoint_path = './checkpoints/cli_latest.npz'
+
+
+def _log(text):
+    print(text, file=sys.stderr)
+
+
+def _new_core(args, lazy=False):
+    from mnist_core import MnistCore
+
+    class CliCore(MnistCore):
+        def log(self, text):
+            _log(text)
+
+    # --model を指定しなければ ./model.hdf5 (なければ既定のモデル) を使う。
+    # 指定したファイルが読み込めなければ RuntimeError になり、終了コードは 1 になる
+    return CliCore(args.model, lazy=lazy)
+
+
+def _create_core(args, timings):
+    from model_creator import ModelCreator
+
+    begin = time.perf_counter()
+    core = _new_core(args)
+    if args.architecture is not None:
+        with open(args.architecture) as f:
+            creator = ModelCreator.from_json(f.read())
+        core.set_model(creator.get_model(), creator)
+    timings["setup"] = time.perf_counter() - begin
+    return core
+
+
+def train(args, result, timings):
+    core = _create_core(args, timings)
+    core.checkpoint_path = args.checkpoint
+    core.set_training_config(batch_size=args.batch_size, augment=not args.no_augment,
+                             time_budget_seconds=args.time_budget, target_f1=args.target_f1)
+    result["train"] = core.train(epochs=args.epochs, verbose=0, resume=args.resume)
+    timings["train"] = result["train"]["seconds"]
+    begin = time.perf_counter()
+    result["f1_score"] = core.report_evaluation()
+    timings["eval"] = time.perf_counter() - begin
+    if args.output is not None:
+        begin = time.perf_counter()
+        core.save(args.output)
+        timings["save"] = time.perf_counter() - begin
+        result["output"] = args.output
+
+
+def evaluate(args, result, timings):
+    core = _create_core(args, timings)
+    begin = time.perf_counter()
+    result["f1_score"] = core.report_evaluation()
+    timings["eval"] = time.perf_counter() - begin
+
+
+def predict(args, result, timings):
+    if args.engine is not None:
+        import numpy_inference
+        begin = time.perf_counter()
+        predict_batch = numpy_inference.load(args.engine).predict
+        timings["setup"] = time.perf_counter() - begin
+    else:
+        predict_batch = _create_core(args, timings).predict_batch
+    images = np.load(args.images).astype(np.float32).reshape(-1, 28, 28, 1)
+    begin = time.perf_counter()
+    y = predict_batch(images)
+    timings["predict"] = time.perf_counter() - begin
+    result["predictions"] = [int(v) for v in np.argmax(y, axis=1)]
+    result["probabilities"] = y.tolist()
+
+
+def export(args, result, timings):
+    core = _create_core(args, timings)
+    begin = time.perf_counter()
+    result["weight_bytes"] = core.export_engine(args.output, "int8" if args.int8 else "numpy")
+    timings["export"] = time.perf_counter() - begin
+    result["output"] = args.output
+
+
+def quantize_report(args, result, timings):
+    core = _create_core(args, timings)
+    begin = time.perf_counter()
+    result["quantization"] = core.quantization_report()
+    timings["report"] = time.perf_counter() - begin
+
+
+def tune_threads(args, result, timings):
+    # 計測はモデルファイルから別のグラフに作ったモデルで行うので、initialize はしない
+    core = _new_core(args, lazy=True)
+    begin = time.perf_counter()
+    result["thread_profile"] = core.tune_threads()
+    timings["tune"] = time.perf_counter() - begin
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="MNIST の学習、評価、予測を GUI なしで行う")
+    subparsers = parser.add_subparsers(dest="command")
+    subparsers.required = True
+
+    def add_model_arguments(p, engine=False):
+        group = p.add_mutually_exclusive_group()
+        group.add_argument("--model", help="モデルのファイル (.hdf5)")
+        group.add_argument("--architecture",
+                           help="ModelCreator.to_json で保存したモデルの構造 (.json)")
+        if engine:
+            group.add_argument("--engine", help="export で保存した NumPy のモデル (.npz)")
+
+    p = subparsers.add_parser("train", help="学習する")
+    add_model_arguments(p)
+    p.add_argument("--epochs", type=int,
+                   help="エポック数 (既定は 1。--time-budget か --target-f1 を指定したときも、この数が上限)")
+    p.add_argument("--time-budget", type=float, help="学習時間の上限 (秒)")
+    p.add_argument("--target-f1", type=float, help="この F1 スコアに届いたら学習を止める")
+    p.add_argument("--batch-size", type=int, default=1000)
+    p.add_argument("--no-augment", action="store_true", help="水増しをしない")
+    p.add_argument("--resume", action="store_true",
+                   help="途中で止まった学習のチェックポイントがあれば、そこから再開する")
+    p.add_argument("--checkpoint", default=default_checkpoint_path,
+                   help="チェックポイントのファイル (.npz)")
+    p.add_argument("--output", help="学習したモデルの保存先")
+    p.set_defaults(func=train)
+
+    p = subparsers.add_parser("eval", help="テストデータで評価する")
+    add_model_arguments(p)
+    p.set_defaults(func=evaluate)
+
+    p = subparsers.add_parser("predict", help="画像の数字を予測する")
+    add_model_arguments(p, engine=True)
+    p.add_argument("images", help="shape=(N, 28, 28) または (N, 28, 28, 1) の .npy (0-255)")
+    p.set_defaults(func=predict)
+
+    p = subparsers.add_parser("export", help="TensorFlow なしで予測できる NumPy のモデルを保存する")
+    add_model_arguments(p)
+    p.add_argument("--output", required=True, help="保存先 (.npz)")
+    p.add_argument("--int8", action="store_true", help="int8 に量子化した重みで保存する")
+    p.set_defaults(func=export)
+
+    p = subparsers.add_parser("quantize-report",
+                              help="int8 に量子化したときの F1 スコアの差と予測の速さを比べる")
+    add_model_arguments(p)
+    p.set_defaults(func=quantize_report)
+
+    p = subparsers.add_parser("tune-threads",
+                              help="学習と予測のスレッド数を計測し直して thread_profile.json に保存する")
+    p.add_argument("--model", help="計測に使うモデルのファイル (.hdf5)")
+    p.set_defaults(func=tune_threads)
+
+    args = parser.parse_args(argv)
+    global_one_line_info.set_destination(_log)
+
+    result = {"command": args.command}
+    timings = {}
+    begin = time.perf_counter()
+    try:
+        args.func(args, result, timings)
+    except RuntimeError as e:
+        result["error"] = str(e)
+    timings["total"] = time.perf_counter() - begin
+    result["timings"] = timings
+    print(json.dumps(result, ensure_ascii=False))
+    return 1 if "error" in result else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,930 @@
+import copy
+import hashlib
+import threading
+import time
+
+import numpy as np
+
+# TensorFlow と keras は読み込みに時間がかかるので、initialize と各メソッドの中で読み込む
+from prediction_cache import PredictionCache
+from training_telemetry import TrainingTelemetry
+from startup_trace import startup_trace
+import numpy_inference
+import quantization
+import mnist_dataset
+import training_checkpoint
+import thread_tuning
+
+default_model_path = './model.hdf5'
+default_batch_size = 1000
+default_prefetch_depth = 4
+default_num_workers = 2
+default_eval_batch_size = 2000
+# 学習中は、この数のバッチごとか、この時間ごとに推論用のモデルへ重みを反映する
+default_snapshot_batches = 10
+default_snapshot_interval_ms = 500
+default_epochs = 1
+# 学習中は、この数のバッチごとと各エポックの終わりにチェックポイントを書く。0 ならエポックの終わりだけ
+default_checkpoint_batches = 50
+# 目標の F1 スコアを指定したときに、学習中に評価する画像の数と間隔。
+# 評価には学習データの末尾のこの数の画像を使い、その画像は学習に使わない
+default_validation_size = 2000
+default_validation_interval_seconds = 5.0
+# 予測に使う実装。keras 以外は replica の重みから作ったエンジンで予測する
+inference_backends = ("keras", "numpy", "int8")
+# 評価結果を覚えておくモデルの数
+max_evaluation_cache_size = 16
+
+
+def weighted_f1_score(confusion):
+    """
+    混同行列から、sklearn.metrics.f1_score(average='weighted') と同じ値を計算する。
+
+    :param confusion: 行が正解、列が予測の混同行列
+    """
+    tp = np.diag(confusion).astype(np.float64)
+    support = confusion.sum(axis=1)
+    predicted = confusion.sum(axis=0)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        precision = np.where(predicted > 0, tp / predicted, 0.0)
+        recall = np.where(support > 0, tp / support, 0.0)
+        f1 = np.where(precision + recall > 0,
+                      2 * precision * recall / (precision + recall), 0.0)
+    return float((f1 * support).sum() / support.sum())
+
+
+def _compile_for_integer_labels(model):
+    """1-of-K 表現用の損失関数でコンパイルされたモデルを、整数のラベルで学習できるようにする"""
+    if model.loss == 'sparse_categorical_crossentropy':
+        return
+    model.compile(loss='sparse_categorical_crossentropy',
+                  optimizer=model.optimizer,
+                  metrics=['accuracy'])
+
+
+class MnistCore(object):
+    """
+    学習、評価、予測、モデルの保存と読み込みを行うクラス
+
+    Qt に依存しないので、GUI なしでも使える。(mnist_cli.py を参照)
+    ログと進捗は log, on_progress (または on_telemetry) をオーバーライドして受け取る。
+
+    model_path を省略すると default_model_path を読み込み、読み込めなければ既定のモデルを使う。
+    model_path を指定したときは、読み込めなければ initialize が RuntimeError を送出する。
+
+    lazy=True のときは、データセットとモデルの準備 (initialize) を呼び出す側に任せる。
+    GUI ではウィンドウを表示してから、別のスレッドで準備する。
+    """
+    def __init__(self, model_path=None, lazy=False):
+        # 指定されたモデルの代わりに既定のモデルで評価してしまわないように、指定されたかどうかを覚えておく
+        self._model_path_given = model_path is not None
+        self.model_path = default_model_path if model_path is None else model_path
+        # initialize が終わるとセットされる
+        self.ready = threading.Event()
+        self._is_learning = False
+        self._is_loading = False
+        # モデルの入れ替えと、学習の開始を排他にする
+        self._model_lock = threading.Lock()
+
+        self.batch_size = default_batch_size
+        self.prefetch_depth = default_prefetch_depth
+        self.num_workers = default_num_workers
+        # 学習データをキャンバスの入力に近づけるために水増しするかどうか
+        self.augment = True
+        self.epochs = default_epochs
+        self.checkpoint_batches = default_checkpoint_batches
+        self.checkpoint_path = training_checkpoint.default_checkpoint_path
+        self._checkpoint_writer = None
+        self._epochs = 0
+        self._completed_epochs = 0
+        # None なら制限しない
+        self.time_budget_seconds = None
+        self.target_f1 = None
+        self.validation_size = default_validation_size
+        self.validation_interval_seconds = default_validation_interval_seconds
+        self._budget = None
+        self._num_samples = 0
+
+        self.X_train = None
+        self.Y_train = None
+        self.X_test = None
+        self.Y_test = None
+
+        self.model = None
+        self.model_creator = None
+        # 予測に使う、model と同じ構造のモデル。学習中は重みのスナップショットで更新する
+        self.replica = None
+        self._replica_lock = threading.Lock()
+        self.snapshot_batches = default_snapshot_batches
+        self.snapshot_interval_ms = default_snapshot_interval_ms
+        self._snapshot_count = 0
+        self._snapshot_time = 0.0
+        self.inference_backend = "keras"
+        # inference_backend が keras 以外のときに、予測に使うエンジン
+        self.inference_engine = None
+        # int8 の入力のスケールを決めるのに使う、X_test の先頭からの画像の数
+        self.calibration_size = quantization.default_calibration_size
+        self.telemetry = TrainingTelemetry()
+        # replica の重みが変わるたびに進める。予測キャッシュのキーに使う
+        self.model_version = 0
+        # 最後にモデルファイルのロードにかかった時間 (秒)
+        self.last_load_seconds = None
+        self.prediction_cache = PredictionCache()
+        self.eval_batch_size = default_eval_batch_size
+        self._evaluation_cache = {}
+        self._evaluation_lock = threading.Lock()
+        self.graph = None
+        # 学習は既定のグラフと keras のセッション、予測は replica 用の別のグラフとセッションで行う。
+        # スレッド数は thread_profile のものを使う
+        self.thread_profile_path = thread_tuning.default_profile_path
+        self.thread_profile = None
+        self.training_session = None
+        self.inference_session = None
+        if not lazy:
+            self.initialize()
+
+    def initialize(self):
+        """
+        TensorFlow の読み込み、データセットとモデルの準備、最初の予測を行う。
+
+        スレッド数のプロファイルがなければ、計測はせずに thread_tuning.default_profile のスレッド数を使う。
+        計測は時間がかかるので、tune_threads で別に行う。
+
+        各段階の時間は startup_trace に記録する。終わると ready をセットし、on_ready を呼ぶ。
+        """
+        with self._startup_phase("import tensorflow, keras"):
+            import tensorflow as tf
+            import keras
+            self.graph = tf.get_default_graph()
+        with self._startup_phase("load dataset"):
+            self._set_train_and_test_data()
+        profile = thread_tuning.load(self.thread_profile_path)
+        if profile is None:
+            profile = thread_tuning.default_profile()
+        self._configure_sessions(profile)
+        with self._startup_phase("load model"):
+            try:
+                self.load(self.model_path)
+            except Exception as e:
+                if self._model_path_given:
+                    raise RuntimeError("{} をロードできませんでした。{}".format(self.model_path, e))
+                self.set_model()
+        with self._startup_phase("warm-up prediction"):
+            self.predict(np.zeros((1, 28, 28, 1), dtype=np.float32))
+        self.ready.set()
+        self.on_ready()
+
+    def tune_threads(self):
+        """
+        学習と予測のスレッド数を計測して決め、thread_profile_path に保存する。
+
+        計測には model_path のモデル (なければ既定のモデル) と同じものを、候補ごとに別のグラフに作って使う。
+        セッションは initialize で作るので、保存した設定は次に initialize したときから使われる。
+        """
+        profile = thread_tuning.tune(self._build_model_for_tuning, self.batch_size, log=self.log)
+        thread_tuning.save(profile, self.thread_profile_path)
+        return profile
+
+    def _build_model_for_tuning(self):
+        from keras.models import load_model
+        try:
+            model = load_model(self.model_path)
+        except Exception as e:
+            if self._model_path_given:
+                raise RuntimeError("{} をロードできませんでした。{}".format(self.model_path, e))
+            return self._default_model()
+        _compile_for_integer_labels(model)
+        return model
+
+    def _configure_sessions(self, profile):
+        """学習と予測のセッションを profile のスレッド数で作る。モデルを作る前に呼ぶ。"""
+        import tensorflow as tf
+        from keras import backend as K
+        self.training_session = tf.Session(
+            graph=self.graph, config=thread_tuning.session_config(profile["training"]))
+        K.set_session(self.training_session)
+        self.inference_session = thread_tuning.IsolatedSession(profile["inference"])
+        self.thread_profile = profile
+        self.log(thread_tuning.format_profile(profile))
+
+    def _startup_phase(self, name):
+        self.on_startup_phase(name)
+        return startup_trace.phase(name)
+
+    def on_startup_phase(self, name):
+        """initialize の各段階を始めるときに呼ばれる"""
+        pass
+
+    def on_ready(self):
+        """initialize が終わったときに、initialize を呼んだスレッドから呼ばれる"""
+        pass
+
+    def log(self, text):
+        print(text)
+
+    def on_progress(self, percent):
+        pass
+
+    def on_telemetry(self, summary):
+        """
+        学習の途中経過。学習のスレッドから telemetry.max_rate_hz を超えない頻度で呼ばれる。
+
+        :param summary: TrainingTelemetry.summary() の結果
+        """
+        self.on_progress(summary["percent"])
+
+    def on_snapshot_published(self):
+        """学習中に replica の重みが更新されたときに、学習のスレッドから呼ばれる"""
+        pass
+
+    def on_model_loaded(self, path, seconds, error):
+        """load_async が終わったときに、ロードしたスレッドから呼ばれる。失敗したときは error が例外"""
+        if error is None:
+            self.log("{} をロードしました。({:.3f} 秒)".format(path, seconds))
+        else:
+            self.log("{} をロードできませんでした。{}".format(path, error))
+
+    def _set_train_and_test_data(self):
+        # 画像は uint8 のメモリマップ、ラベルは整数のまま保持する。
+        # float32 への変換は学習時にバッチごとに行う
+        dataset = mnist_dataset.load()
+        self.X_train = dataset.X_train
+        self.X_test = dataset.X_test
+        self.Y_train = dataset.Y_train
+        self.Y_test = dataset.Y_test
+        self.log(self._memory_report())
+
+    def _memory_report(self):
+        """
+        以前の表現と比べたデータのサイズ。以前の表現は保持していないので、型から見積もる。
+
+        以前は fetch_mldata の元データ (uint8 の画像と float64 のラベル) を保持したまま、
+        並べ替えた uint8 の画像と 1-of-K 表現 (float64) のラベルを別に持っていた。
+        """
+        n = len(self.X_train) + len(self.X_test)
+        image_bytes = 28 * 28 * np.dtype(np.uint8).itemsize
+        label_bytes = np.dtype(np.float64).itemsize
+        legacy = n * (image_bytes + label_bytes)  # fetch_mldata の元データ
+        legacy += n * (image_bytes + 10 * label_bytes)  # 並べ替えた画像と 1-of-K 表現のラベル
+        current = sum(a.nbytes for a in (self.X_train, self.X_test,
+                                          self.Y_train, self.Y_test))
+        return "dataset memory (estimate): {:.1f} MB -> {:.1f} MB"\
+            .format(legacy / 2 ** 20, current / 2 ** 20)
+
+    def load(self, path):
+        if self._is_learning:
+            raise RuntimeError("学習中なのでモデルのロードはできません。")
+        model, seconds = self._load_model_file(path)
+        self._swap_model(model, None)
+        self.last_load_seconds = seconds
+
+    def load_async(self, path):
+        """
+        別のスレッドでモデルをロードし、準備ができたら入れ替える。
+
+        ロード中も以前のモデルで予測できる。終わったら on_model_loaded が呼ばれる。
+
+        :return: ロードするスレッド
+        """
+        with self._model_lock:
+            if self._is_learning:
+                raise RuntimeError("学習中なのでモデルのロードはできません。")
+            if self._is_loading:
+                raise RuntimeError("モデルをロード中です。")
+            self._is_loading = True
+
+        def run():
+            seconds, error = None, None
+            try:
+                model, seconds = self._load_model_file(path)
+                self._swap_model(model, None)
+                self.last_load_seconds = seconds
+            except Exception as e:
+                error = e
+            finally:
+                self._is_loading = False
+            self.on_model_loaded(path, seconds, error)
+
+        thread = threading.Thread(target=run, daemon=True)
+        thread.start()
+        return thread
+
+    def _load_model_file(self, path):
+        """
+        モデルファイルを読み込み、予測できる状態にする。
+
+        :return: (keras のモデル, かかった時間 (秒))
+        """
+        from keras.models import load_model
+        begin = time.perf_counter()
+        with self.graph.as_default():
+            model = load_model(path)
+            _compile_for_integer_labels(model)
+            # 最初の予測は関数の構築で遅いので、入れ替える前に済ませておく
+            model.predict(np.zeros((1, 28, 28, 1), dtype=np.float32))
+        return model, time.perf_counter() - begin
+
+    def _swap_model(self, model, model_creator):
+        """
+        モデルを入れ替える。
+
+        予測は入れ替える前に取り出したモデルで最後まで行われる。
+        """
+        replica = self._replica_for(model)
+        with self.graph.as_default():
+            weights = model.get_weights()
+        with self._model_lock:
+            if self._is_learning:
+                raise RuntimeError("学習中なので、モデルの設定はできません。")
+            engine = self._build_engine(self.inference_backend, model, weights)
+            with self._replica_lock, self.inference_session.as_default():
+                replica.set_weights(weights)
+                self.replica = replica
+                self.inference_engine = engine
+                self.model = model
+                self.model_creator = model_creator
+                self._advance_model_version()
+
+    def _replica_for(self, model):
+        """model と同じ構造の予測用のモデルを返す。今の replica と同じ構造なら使い回す。"""
+        from keras.models import clone_model
+        replica = self.replica
+        with self.inference_session.as_default():
+            if replica is None or replica.to_json() != model.to_json():
+                replica = clone_model(model)
+                replica.predict(np.zeros((1, 28, 28, 1), dtype=np.float32))
+        return replica
+
+    def _make_engine(self, backend, model, weights=None, input_scales=None):
+        """
+        backend のエンジンを作る。keras なら None
+
+        :param input_scales: int8 のときに使う入力のスケール。None なら X_test の画像で決める
+        """
+        if backend == "keras":
+            return None
+        engine = numpy_inference.export(model, weights)
+        if backend == "int8":
+            if input_scales is not None:
+                return quantization.quantize(engine, input_scales=input_scales)
+            calibration_images = np.asarray(self.X_test[:self.calibration_size], dtype=np.float32)
+            engine = quantization.quantize(engine, calibration_images)
+        return engine
+
+    def _build_engine(self, backend, model, weights, input_scales=None):
+        """_make_engine と同じだが、作れない層があれば keras に戻す。"""
+        try:
+            return self._make_engine(backend, model, weights, input_scales)
+        except RuntimeError as e:
+            self.inference_backend = "keras"
+            self.log("{} では予測できないので keras で予測します。{}".format(backend, e))
+            return None
+
+    def export_engine(self, path, backend="numpy"):
+        """
+        今のモデルを TensorFlow なしで予測できる .npz に保存する。numpy_inference.load で読み込める。
+
+        :param backend: "numpy" なら float32、"int8" なら量子化した重みで保存する
+        :return: 保存した重みの大きさ (バイト)
+        """
+        if backend not in ("numpy", "int8"):
+            raise RuntimeError("{} のモデルは保存できません。".format(backend))
+        model, _ = self._current_model()
+        with self.graph.as_default():
+            engine = self._make_engine(backend, model)
+        engine.save(path)
+        return engine.saved_nbytes() if backend == "int8" else engine.nbytes()
+
+    def set_inference_backend(self, backend):
+        """予測に使う実装を切り替える。"""
+        if backend not in inference_backends:
+            raise RuntimeError("{} は予測に使えません。".format(backend))
+        if not self.ready.is_set():
+            raise RuntimeError("モデルを準備中なので、予測の実装は変更できません。")
+        with self._replica_lock, self.inference_session.as_default():
+            if self.replica is not None:
+                # replica の重みは学習中のモデルと違うことがあるので、replica から作る
+                self.inference_engine = self._make_engine(backend, self.replica)
+            self.inference_backend = backend
+            # 実装によって結果がわずかに違うので、以前の予測結果は使わない
+            self.prediction_cache.clear()
+
+    def publish_snapshot(self, recalibrate=False):
+        """
+        学習中のモデルの重みを replica に反映する。学習のスレッドから呼ぶ。
+
+        int8 のエンジンは、学習を止めないように入力のスケールを前のエンジンから引き継ぐ。
+
+        :param recalibrate: int8 の入力のスケールを画像で決め直す。学習の終わりに使う
+        """
+        input_scales = None
+        engine = self.inference_engine
+        if not recalibrate and isinstance(engine, quantization.QuantizedModel):
+            input_scales = engine.input_scales
+        with self.graph.as_default():
+            weights = self.model.get_weights()
+            engine = self._build_engine(self.inference_backend, self.model, weights, input_scales)
+        with self._replica_lock, self.inference_session.as_default():
+            self.replica.set_weights(weights)
+            self.inference_engine = engine
+            self._advance_model_version()
+        self._snapshot_time = time.perf_counter()
+        self.on_snapshot_published()
+
+    def _current_model(self):
+        """評価に使うモデルとそのバージョン"""
+        with self._model_lock:
+            return self.model, self.model_version
+
+    def _advance_model_version(self):
+        self.model_version += 1
+
+    def save(self, path):
+        if self._is_learning:
+            raise RuntimeError("学習中なので、モデルはセーブできません。")
+        else:
+            self.model.save(path)
+
+    def get_weights(self):
+        if self._is_learning:
+            raise RuntimeError("学習中なので、重みは取り出せません。")
+        with self.graph.as_default():
+            return self.model.get_weights()
+
+    def set_training_config(self, batch_size=None, prefetch_depth=None, num_workers=None,
+                            augment=None, snapshot_batches=None, snapshot_interval_ms=None,
+                            epochs=None, checkpoint_batches=None,
+                            time_budget_seconds=None, target_f1=None):
+        """
+        学習の設定を変更する。None の引数は変更しない。
+        time_budget_seconds と target_f1 は 0 を指定すると制限しなくなる。
+        """
+        if self._is_learning:
+            raise RuntimeError("学習中なので、学習の設定は変更できません。")
+        if batch_size is not None:
+            if batch_size < 1:
+                raise RuntimeError("バッチサイズは1以上を指定してください。")
+            self.batch_size = batch_size
+        if prefetch_depth is not None:
+            if prefetch_depth < 1:
+                raise RuntimeError("先読みするバッチの数は1以上を指定してください。")
+            self.prefetch_depth = prefetch_depth
+        if num_workers is not None:
+            if num_workers < 1:
+                raise RuntimeError("ワーカーの数は1以上を指定してください。")
+            self.num_workers = num_workers
+        if augment is not None:
+            self.augment = augment
+        if snapshot_batches is not None:
+            if snapshot_batches < 1:
+                raise RuntimeError("スナップショットの間隔は1バッチ以上を指定してください。")
+            self.snapshot_batches = snapshot_batches
+        if snapshot_interval_ms is not None:
+            self.snapshot_interval_ms = snapshot_interval_ms
+        if epochs is not None:
+            if epochs < 1:
+                raise RuntimeError("エポック数は1以上を指定してください。")
+            self.epochs = epochs
+        if checkpoint_batches is not None:
+            if checkpoint_batches < 0:
+                raise RuntimeError("チェックポイントの間隔は0以上を指定してください。")
+            self.checkpoint_batches = checkpoint_batches
+        if time_budget_seconds is not None:
+            if time_budget_seconds < 0:
+                raise RuntimeError("学習時間は0以上を指定してください。")
+            self.time_budget_seconds = time_budget_seconds or None
+        if target_f1 is not None:
+            if not 0 <= target_f1 <= 1:
+                raise RuntimeError("目標の F1 スコアは0から1の間で指定してください。")
+            self.target_f1 = target_f1 or None
+
+    def train(self, epochs=None, verbose=1, resume=False):
+        """
+        学習を実行する。
+
+        time_budget_seconds か target_f1 が設定されていれば、時間を使い切るか、
+        validation_interval_seconds ごとの評価で目標に届いた時点で学習を止める。
+        そのときもエポック数が上限になり、進捗と残り時間は time_budget_seconds に届く方で計算する。
+
+        :param epochs: エポック数。None なら self.epochs
+        :param resume: 同じ構造のモデルの学習が途中で止まったチェックポイントがあれば、そこから再開する
+        :return: 学習にかかった時間などの dict
+        """
+        budgeted = self._is_budgeted()
+        epochs = self._train_epochs(epochs)
+        from keras.callbacks import LambdaCallback
+        from batch_pipeline import MnistSequence, AugmentedSequence
+        with self._model_lock:
+            if self.model is None:
+                raise RuntimeError("モデルがありません。")
+            if self._is_loading:
+                raise RuntimeError("モデルをロード中です。")
+            self._is_learning = True
+        try:
+            X_train, Y_train = self.X_train, self.Y_train
+            if self.target_f1 is not None:
+                # 止める判断をテストデータでするとランキングの F1 スコアが偏るので、学習データから取り分ける
+                n = self._validation_count()
+                X_train, Y_train = X_train[:-n], Y_train[:-n]
+            if self.augment:
+                train_sequence = AugmentedSequence(X_train, Y_train, self.batch_size)
+            else:
+                train_sequence = MnistSequence(X_train, Y_train, self.batch_size)
+            test_sequence = MnistSequence(self.X_test, self.Y_test, self.batch_size,
+                                          shuffle=False)
+            initial_epoch = self._resume_from_checkpoint(epochs) if resume else 0
+            self._epochs = epochs
+            self._completed_epochs = initial_epoch
+            num_batch = len(train_sequence) * (epochs - initial_epoch)
+
+            self.on_progress(0)
+            self.log("start learning")
+            begin = time.perf_counter()
+            count = [0]
+            self._num_samples = 0
+            self._snapshot_count = 0
+            self._snapshot_time = begin
+            self.telemetry.reset(num_batch, self.time_budget_seconds)
+            self._budget = None
+            if budgeted:
+                self._budget = {"begin": begin,
+                                "last_validation": begin,
+                                "stop_reason": None,
+                                "time_to_target": None,
+                                "validations": []}
+
+            def batch_end_out(batch, logs):
+                count[0] += 1
+                self._num_samples += logs.get("size", 0)
+                self.on_batch_end(count[0], num_batch, logs)
+                if self._budget is not None:
+                    self._check_budget()
+
+            def epoch_end_out(epoch, logs):
+                # 中止されたときも呼ばれるが、そのエポックは終わっていない
+                if not self.model.stop_training:
+                    self._completed_epochs = epoch + 1
+                    self._submit_checkpoint()
+
+            with self.graph.as_default():
+                # バッチの作成は workers 個のスレッド (水増しする場合はプロセス) で行い、
+                # prefetch_depth 個まで先読みする
+                history = self.model.fit_generator(train_sequence,
+                                                   validation_data=test_sequence,
+                                                   epochs=epochs,
+                                                   initial_epoch=initial_epoch,
+                                                   workers=self.num_workers,
+                                                   max_queue_size=self.prefetch_depth,
+                                                   use_multiprocessing=self.augment,
+                                                   verbose=verbose,
+                                                   callbacks=[LambdaCallback(on_batch_end=batch_end_out,
+                                                                             on_epoch_end=epoch_end_out)])
+            seconds = time.perf_counter() - begin
+            self.publish_snapshot(recalibrate=True)
+            # 時間か目標で止めた学習は、最後まで学習したものとして再開しない
+            finished = self._budget is not None and self._budget["stop_reason"] is not None
+            # 最後のチェックポイントだけは、書き終わるまで待つ
+            self._submit_checkpoint(finished)
+            self._checkpoint_writer.flush()
+            self.log("end learning")
+        finally:
+            self._is_learning = False
+        result = {"epochs": len(history.epoch),
+                  "initial_epoch": initial_epoch,
+                  "batch_size": self.batch_size,
+                  "seconds": seconds,
+                  "num_samples": self._num_samples,
+                  "samples_per_second": self._num_samples / seconds if seconds > 0 else 0.0,
+                  "history": {k: [float(v) for v in vs] for k, vs in history.history.items()}}
+        if self._budget is not None:
+            result["budget"] = {"time_budget_seconds": self.time_budget_seconds,
+                                "target_f1": self.target_f1,
+                                "stop_reason": self._budget["stop_reason"],
+                                "time_to_target": self._budget["time_to_target"],
+                                "validations": self._budget["validations"]}
+        return result
+
+    def _is_budgeted(self):
+        return self.time_budget_seconds is not None or self.target_f1 is not None
+
+    def _train_epochs(self, epochs):
+        """train に epochs を渡したときに学習するエポック数"""
+        return self.epochs if epochs is None else epochs
+
+    def on_batch_end(self, count, num_batch, logs):
+        """count 個目のバッチの学習が終わったときに呼ばれる"""
+        elapsed_ms = (time.perf_counter() - self._snapshot_time) * 1000
+        if count - self._snapshot_count >= self.snapshot_batches \
+                or elapsed_ms >= self.snapshot_interval_ms:
+            self._snapshot_count = count
+            self.publish_snapshot()
+        if self.checkpoint_batches and count % self.checkpoint_batches == 0:
+            self._submit_checkpoint()
+        self.telemetry.record(count, logs)
+        if self.telemetry.due():
+            self.on_telemetry(self.telemetry.summary())
+
+    def _check_budget(self):
+        """時間を使い切ったか、目標の F1 スコアに届いていれば学習を止める。学習のスレッドから呼ぶ。"""
+        budget = self._budget
+        now = time.perf_counter()
+        elapsed = now - budget["begin"]
+        if self.target_f1 is not None \
+                and now - budget["last_validation"] >= self.validation_interval_seconds:
+            f1_score = self._validate()
+            budget["last_validation"] = time.perf_counter()
+            budget["validations"].append({"seconds": elapsed,
+                                          "num_samples": self._num_samples,
+                                          "f1_score": f1_score})
+            self.log("validation f1 {:.4f} ({:.1f} s)".format(f1_score, elapsed))
+            if f1_score >= self.target_f1:
+                budget["stop_reason"] = "target"
+                budget["time_to_target"] = elapsed
+                self.model.stop_training = True
+                return
+        if self.time_budget_seconds is not None and elapsed >= self.time_budget_seconds:
+            budget["stop_reason"] = "time"
+            self.model.stop_training = True
+
+    def _validation_count(self):
+        """学習に使わずに残す画像の数。学習データが少なくても半分は学習に使う"""
+        return max(min(self.validation_size, len(self.X_train) // 2), 1)
+
+    def _validate(self):
+        """学習に使っていない学習データの末尾だけで、学習中のモデルの F1 スコアを計算する。"""
+        n = self._validation_count()
+        with self.graph.as_default():
+            return self._evaluate_with(
+                lambda x: self.model.predict(x, batch_size=self.eval_batch_size),
+                self.X_train[-n:], self.Y_train[-n:])["f1_score"]
+
+    def _submit_checkpoint(self, finished=False):
+        """
+        重みと最適化の状態を取り出して、書き込むスレッドに渡す。学習のスレッドから呼ぶ。
+
+        取り出すのは学習のスレッドで行うが、ファイルへの書き込みは待たない。
+
+        :param finished: エポックが残っていても、再開しないチェックポイントにする
+        """
+        if self._checkpoint_writer is None or self._checkpoint_writer.path != self.checkpoint_path:
+            self._checkpoint_writer = training_checkpoint.CheckpointWriter(self.checkpoint_path)
+            self._checkpoint_writer.start()
+        with self.graph.as_default():
+            weights = self.model.get_weights()
+            optimizer_weights = self.model.optimizer.get_weights()
+            signature = training_checkpoint.architecture_signature(self.model)
+        self._checkpoint_writer.submit({
+            "meta": {"architecture": signature,
+                     "epochs": self._epochs,
+                     "completed_epochs": self._completed_epochs,
+                     "finished": finished,
+                     "created_at": time.time()},
+            "weights": weights,
+            "optimizer": optimizer_weights})
+
+    def resumable_checkpoint(self, epochs=None):
+        """
+        今のモデルと同じ構造で、学習が途中で止まったチェックポイントを返す。
+
+        構造が同じなら別のモデルのチェックポイントでも再開できてしまうので、
+        再開するかどうかは呼び出す側 (GUI ではユーザー) が決める。
+
+        GUI のスレッドから呼んでも重くならないように、チェックポイントの meta だけを読む。
+
+        :param epochs: train に渡すエポック数
+        :return: チェックポイントの meta。再開できるものがなければ None
+        """
+        epochs = self._train_epochs(epochs)
+        try:
+            meta = training_checkpoint.load_meta(self.checkpoint_path)
+        except (OSError, ValueError, KeyError) as e:
+            self.log("チェックポイントを読み込めませんでした。" + str(e))
+            return None
+        if meta is None:
+            return None
+        if meta["architecture"] != training_checkpoint.architecture_signature(self.model):
+            return None
+        completed_epochs = meta["completed_epochs"]
+        if meta.get("finished") or completed_epochs >= meta["epochs"] \
+                or completed_epochs >= epochs:
+            # 最後まで学習したチェックポイントからは再開しない
+            return None
+        return meta
+
+    def _resume_from_checkpoint(self, epochs):
+        """
+        再開できるチェックポイントがあれば、その重みと最適化の状態を設定する。
+
+        データはエポックの途中からではなく、最後に終わったエポックの次から学習し直す。
+
+        :return: 終わっているエポック数。再開しないときは 0
+        """
+        if self.resumable_checkpoint(epochs) is None:
+            return 0
+        try:
+            checkpoint = training_checkpoint.load(self.checkpoint_path)
+        except (OSError, ValueError, KeyError) as e:
+            self.log("チェックポイントを読み込めませんでした。" + str(e))
+            return 0
+        completed_epochs = checkpoint["meta"]["completed_epochs"]
+        with self.graph.as_default():
+            self.model.set_weights(checkpoint["weights"])
+            # 最適化の状態の変数は、学習の関数を作るときに作られる
+            self.model._make_train_function()
+            self.model.optimizer.set_weights(checkpoint["optimizer"])
+        self.publish_snapshot()
+        self.log("チェックポイントから再開します。(epoch {}/{})".format(completed_epochs + 1, epochs))
+        return completed_epochs
+
+    def checkpoint_info(self):
+        writer = self._checkpoint_writer
+        if writer is None:
+            return "checkpoint: not written"
+        text = "checkpoint: written {} / dropped {}".format(writer.num_written, writer.num_dropped)
+        if writer.last_write_seconds is not None:
+            text += " / last write {:.3f} s".format(writer.last_write_seconds)
+        if writer.last_error is not None:
+            text += " / error " + str(writer.last_error)
+        return text
+
+    def thread_info(self):
+        if self.thread_profile is None:
+            return "threads: not configured"
+        return thread_tuning.format_profile(self.thread_profile)
+
+    def is_learning(self):
+        return self._is_learning
+
+    def stop_learning(self):
+        self.model.stop_training = True
+
+    def predict(self, image):
+        """学習中のモデルではなく、replica (または inference_engine) で予測する。"""
+        with self._replica_lock:
+            if self.replica is None:
+                return
+            engine, version = self.inference_engine, self.model_version
+        key = self.prediction_cache.make_key(image, version)
+        y = self.prediction_cache.get(key)
+        if y is None:
+            y = self._predict_with(engine, image).reshape(10)
+            self.prediction_cache.put(key, y)
+        return y
+
+    def predict_batch(self, images):
+        """キャッシュを使わずにまとめて予測する。shape=(N, 10) を返す。"""
+        with self._replica_lock:
+            engine = self.inference_engine
+        return self._predict_with(engine, images)
+
+    def _predict_with(self, engine, images):
+        if engine is not None:
+            # エンジンは作り直すだけで変更しないので、ロックはいらない
+            return engine.predict(images)
+        # 学習とは別のグラフとセッションで、予測用のスレッド数で計算する
+        with self._replica_lock, self.inference_session.as_default():
+            return self.replica.predict(images)
+
+    def set_model(self, model=None, model_creator=None):
+        if self._is_learning:
+            raise RuntimeError("学習中なので、モデルの設定はできません。")
+        if model is None:
+            with self.graph.as_default():
+                model = self._default_model()
+            self._swap_model(model, None)
+        else:
+            with self.graph.as_default():
+                _compile_for_integer_labels(model)
+            self._swap_model(model, copy.copy(model_creator))
+
+    @staticmethod
+    def _default_model():
+        """既定のモデルを今のグラフに作る"""
+        from keras.models import Sequential
+        from keras.layers.core import Dense, Activation, Flatten, Dropout
+        from keras.layers.convolutional import Convolution2D, MaxPooling2D
+        from keras.layers.normalization import BatchNormalization
+        from keras.optimizers import Adam
+        model = Sequential()
+
+        model.add(Convolution2D(15,
+                                (3, 3),
+                                input_shape=(28, 28, 1),
+                                activation='relu'))
+        model.add(MaxPooling2D())
+        model.add(Convolution2D(15,
+                                (3, 3),
+                                activation='relu'))
+        model.add(MaxPooling2D())
+        model.add(Flatten())
+
+        model.add(BatchNormalization())
+
+        model.add(Dense(200))
+
+        model.add(Dropout(0.5))
+
+        model.add(Dense(10))
+        model.add(Activation('softmax'))
+
+        model.compile(loss='sparse_categorical_crossentropy',
+                      optimizer=Adam(lr=0.01),
+                      metrics=['accuracy'])
+        return model
+
+    def weights_fingerprint(self, model=None):
+        """モデルの構造と重みのハッシュ"""
+        if model is None:
+            model = self.model
+        h = hashlib.blake2b(digest_size=16)
+        with self.graph.as_default():
+            h.update(model.to_json().encode())
+            for w in model.get_weights():
+                h.update(np.ascontiguousarray(w).data)
+        return h.hexdigest()
+
+    def evaluate(self):
+        """
+        テストデータで評価する。
+
+        eval_batch_size ずつ予測するので、テストデータ全体の予測結果は保持しない。
+        結果は重みのハッシュごとに覚えておき、同じモデルなら計算し直さない。
+
+        :return: {"f1_score": 重み付き F1 スコア, "accuracy": 正解率, "confusion_matrix": 10x10 の混同行列}
+        """
+        # 評価中にモデルが入れ替わっても、最後まで同じモデルで評価する
+        model, _ = self._current_model()
+        fingerprint = self.weights_fingerprint(model)
+        with self._evaluation_lock:
+            result = self._evaluation_cache.get(fingerprint)
+        if result is not None:
+            return result
+
+        with self.graph.as_default():
+            result = self._evaluate_with(
+                lambda x: model.predict(x, batch_size=self.eval_batch_size))
+
+        with self._evaluation_lock:
+            self._evaluation_cache[fingerprint] = result
+            while len(self._evaluation_cache) > max_evaluation_cache_size:
+                self._evaluation_cache.pop(next(iter(self._evaluation_cache)))
+        return result
+
+    def clear_evaluation_cache(self):
+        """evaluate が覚えている評価結果を捨てる"""
+        with self._evaluation_lock:
+            self._evaluation_cache.clear()
+
+    def _evaluate_with(self, predict, X=None, Y=None):
+        """predict(x) で X (省略したら X_test) を eval_batch_size ずつ予測して評価する。"""
+        if X is None:
+            X, Y = self.X_test, self.Y_test
+        confusion = np.zeros((10, 10), dtype=np.int64)
+        for begin in range(0, len(X), self.eval_batch_size):
+            end = begin + self.eval_batch_size
+            x = np.asarray(X[begin:end], dtype=np.float32)
+            y_pred = predict(x).argmax(axis=1)
+            y_true = np.asarray(Y[begin:end], dtype=np.int64)
+            # 行が正解、列が予測
+            confusion += np.bincount(y_true * 10 + y_pred, minlength=100).reshape(10, 10)
+        return {"f1_score": weighted_f1_score(confusion),
+                "accuracy": float(np.trace(confusion) / confusion.sum()),
+                "confusion_matrix": confusion}
+
+    def report_evaluation(self):
+        return self.evaluate()["f1_score"]
+
+    def quantization_report(self, repeat=100):
+        """
+        今のモデルを int8 に量子化したときの、F1 スコアの差と予測の速さを比べる。
+
+        :return: {"f1_score": {...}, "f1_delta", "latency_ms": {...}, "model_bytes": {...}}
+                 latency_ms は１枚の予測にかかる時間の中央値
+        """
+        if self._is_learning:
+            raise RuntimeError("学習中なので、量子化の評価はできません。")
+        model, _ = self._current_model()
+        with self.graph.as_default():
+            engines = {"keras": None,
+                       "numpy": self._make_engine("numpy", model),
+                       "int8": self._make_engine("int8", model)}
+        float_f1 = self.report_evaluation()
+        int8_f1 = self._evaluate_with(engines["int8"].predict)["f1_score"]
+
+        image = np.asarray(self.X_test[:1], dtype=np.float32)
+        latency_ms = {}
+        for backend, engine in engines.items():
+            self._predict_with(engine, image)
+            seconds = []
+            for _ in range(repeat):
+                begin = time.perf_counter()
+                self._predict_with(engine, image)
+                seconds.append(time.perf_counter() - begin)
+            latency_ms[backend] = float(np.median(seconds)) * 1000
+        return {"f1_score": {"keras": float_f1, "int8": int8_f1},
+                "f1_delta": int8_f1 - float_f1,
+                "latency_ms": latency_ms,
+                # 予測に使うメモリは int8 でもほとんど変わらない。小さくなるのは保存したファイル
+                "model_bytes": {"float32": engines["numpy"].nbytes(),
+                                "int8_resident": engines["int8"].nbytes(),
+                                "int8_saved": engines["int8"].saved_nbytes()}}
@@ -0,0 +1,86 @@
+"""
+MNIST のデータセットを .npy 形式でキャッシュするモジュール
+
+一度だけ fetch_mldata から変換しておけば、起動時は np.load(mmap_mode='r') で
+開くだけになる。オフラインでも起動でき、同じマシンで起動した複数のアプリが
+ページキャッシュを共有できる。
+
+変換は次のコマンドで実行できる。(起動時にキャッシュがない場合も自動で変換する)
+
+    python mnist_dataset.py
+"""
+import os
+import shutil
+
+import numpy as np
+
+default_cache_dir = './mnist_cache'
+
+_file_names = ('images.npy', 'labels.npy', 'train_indices.npy', 'test_indices.npy')
+
+
+class MnistDataset:
+    """
+    学習用とテスト用に分割された MNIST
+
+    画像は shape=(N, 28, 28, 1) の uint8、ラベルは shape=(N,) の int8。
+    学習用、テスト用の順に並べて保存してあるので、どちらもメモリマップのスライスになる。
+    train_indices, test_indices は、元の MNIST での番号を表す。
+    """
+    def __init__(self, images, labels, train_indices, test_indices):
+        n_train = len(train_indices)
+        self.X_train = images[:n_train]
+        self.Y_train = labels[:n_train]
+        self.X_test = images[n_train:]
+        self.Y_test = labels[n_train:]
+        self.train_indices = train_indices
+        self.test_indices = test_indices
+
+
+def exists(cache_dir=default_cache_dir):
+    return all(os.path.exists(os.path.join(cache_dir, name)) for name in _file_names)
+
+
+def convert(cache_dir=default_cache_dir, data_home='.'):
+    """fetch_mldata で MNIST を取得し、学習用とテスト用に分割してキャッシュに書き出す。"""
+    from sklearn import datasets
+    from sklearn.model_selection import train_test_split
+
+    mnist = datasets.fetch_mldata('MNIST original', data_home=data_home)
+
+    # 以前 MnistModel で行っていた分割と同じ結果になるようにする
+    np.random.seed(0)
+    n = len(mnist.data)
+    indices = np.random.permutation(range(n))[:n]
+    train_indices, test_indices = train_test_split(indices, test_size=0.2)
+    order = np.concatenate([train_indices, test_indices])
+
+    images = mnist.data[order].astype(np.uint8).reshape(-1, 28, 28, 1)
+    labels = mnist.target[order].astype(np.int8)
+
+    # 途中で失敗しても壊れたキャッシュが残らないように、書き終えてから置き換える
+    tmp_dir = cache_dir + '.tmp'
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    os.makedirs(tmp_dir)
+    np.save(os.path.join(tmp_dir, 'images.npy'), images)
+    np.save(os.path.join(tmp_dir, 'labels.npy'), labels)
+    np.save(os.path.join(tmp_dir, 'train_indices.npy'), train_indices.astype(np.int32))
+    np.save(os.path.join(tmp_dir, 'test_indices.npy'), test_indices.astype(np.int32))
+    shutil.rmtree(cache_dir, ignore_errors=True)
+    os.replace(tmp_dir, cache_dir)
+
+
+def load(cache_dir=default_cache_dir):
+    """キャッシュをメモリマップで開く。キャッシュがなければ先に変換する。"""
+    if not exists(cache_dir):
+        convert(cache_dir)
+
+    def open_npy(name):
+        return np.load(os.path.join(cache_dir, name), mmap_mode='r')
+
+    return MnistDataset(*[open_npy(name) for name in _file_names])
+
+
+if __name__ == '__main__':
+    convert()
+    print("saved to " + default_cache_dir)
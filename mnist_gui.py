@@ -1,12 +1,23 @@
+# 起動の時間を計測するので、最初に読み込む
+from startup_trace import startup_trace
+
+import json
+import threading
+import time
+
 from PyQt5.QtCore import QDir, Qt
 from PyQt5.QtGui import QPalette, QPixmap
 from PyQt5.QtWidgets import *
 
 from mnist_model import MnistModel
+from mnist_core import inference_backends
 from hand_writing_widget import HandWritingWidget
 from model_editor_widet import ModelEditorWidget
 from ranking_widget import RankingWidget
 from one_line_info import global_one_line_info
+from inference_worker import PREDICT_LIVE, PREDICT_THROTTLED, PREDICT_STROKE_END
+
+startup_trace.add("import gui modules", startup_trace.origin)
 
 
 appStyle = """
@@ -88,6 +99,7 @@ class MainWindow(QMainWindow):
         self.tab.addTab(self.Ranking, "Ranking")
 
         self.model.set_update_bar_func(self.HandWriting.scribbleArea.outputAcc)
+        self.model.ready_signal.connect(self.modelReady)
 
         self.learn_btn = QPushButton("学習開始", self)
         self.learn_btn.clicked.connect(self.learn)
@@ -102,6 +114,9 @@ class MainWindow(QMainWindow):
         self.setMinimumWidth(800)
         self.setMinimumHeight(600)
 
+        # データセットとモデルの準備ができるまで、モデルを使う操作はできないようにする
+        self.setModelReady(False)
+        global_one_line_info.send("準備中...")
         self.model.start()
         #self.initUI(self.width, self.height)
 
@@ -120,8 +135,43 @@ class MainWindow(QMainWindow):
         self.textArea.move(self.width() * 0.01, self.height() * 0.4)
         self.textArea.resize(self.width() * 0.18, self.height() * 0.5)
 
+    def setModelReady(self, ready):
+        self.learn_btn.setEnabled(ready)
+        self.stop_btn.setEnabled(ready)
+        self.tab.setTabEnabled(self.tab.indexOf(self.ModelEditor), ready)
+        self.tab.setTabEnabled(self.tab.indexOf(self.Ranking), ready)
+        self.quantizationReportAct.setEnabled(ready)
+        self.inferenceBackendAct.setEnabled(ready)
+
+    def modelReady(self):
+        self.setModelReady(True)
+        startup_trace.mark("model ready")
+        self.model.log(startup_trace.format())
+        try:
+            startup_trace.save()
+        except OSError as e:
+            print(e)
+        global_one_line_info.send("準備ができました。({:.3f} 秒)"
+                                  .format(time.perf_counter() - startup_trace.origin))
+        self.HandWriting.scribbleArea.outputAcc()
+
     def learn(self, event):
-        self.model.learn_event.set()
+        resume = False
+        meta = None
+        if not self.model.is_learning():
+            meta = self.model.resumable_checkpoint()
+        if meta is not None:
+            ret = QMessageBox.question(
+                self, "MNIST GUI",
+                "途中で止まった学習のチェックポイントがあります。(epoch {}/{})\n"
+                "続きから再開しますか？\n"
+                "再開すると、今のモデルの重みはチェックポイントの重みで置き換えられます。"
+                .format(meta["completed_epochs"], meta["epochs"]),
+                QMessageBox.Yes | QMessageBox.No | QMessageBox.Cancel, QMessageBox.No)
+            if ret == QMessageBox.Cancel:
+                return
+            resume = ret == QMessageBox.Yes
+        self.model.start_learning(resume)
 
     def stop_learning(self, event):
         self.model.stop_learning()
@@ -129,6 +179,7 @@ class MainWindow(QMainWindow):
     def closeEvent(self, event):
         if self.exitWarn():
             self.model.kill()
+            self.HandWriting.scribbleArea.inference.kill()
             event.accept()
         else:
             event.ignore()
@@ -149,6 +200,127 @@ class MainWindow(QMainWindow):
         if ok:
             self.HandWriting.scribbleArea.setPenWidth(newWidth)
 
+    def predictionMode(self):
+        inference = self.HandWriting.scribbleArea.inference
+        modes = [PREDICT_LIVE, PREDICT_THROTTLED, PREDICT_STROKE_END]
+        mode, ok = QInputDialog.getItem(self, "MNIST GUI",
+                                        "Select prediction mode:",
+                                        modes, modes.index(inference.mode), False)
+        if not ok:
+            return
+        rate_hz = None
+        if mode == PREDICT_THROTTLED:
+            rate_hz, ok = QInputDialog.getDouble(self, "MNIST GUI",
+                                                 "Predictions per second:",
+                                                 inference.rate_hz, 0.1, 120.0, 1)
+            if not ok:
+                return
+        max_count, ok = QInputDialog.getInt(self, "MNIST GUI",
+                                            "Max predictions per stroke (0 = unlimited):",
+                                            inference.max_predictions_per_stroke,
+                                            0, 10000, 1)
+        if not ok:
+            return
+        inference.set_mode(mode, rate_hz, max_count)
+
+    def trainingSettings(self):
+        batch_size, ok = QInputDialog.getInt(self, "MNIST GUI",
+                                             "Batch size:",
+                                             self.model.batch_size, 1, 60000, 1)
+        if not ok:
+            return
+        prefetch_depth, ok = QInputDialog.getInt(self, "MNIST GUI",
+                                                 "Prefetched batches:",
+                                                 self.model.prefetch_depth, 1, 100, 1)
+        if not ok:
+            return
+        items = ["on", "off"]
+        augment, ok = QInputDialog.getItem(self, "MNIST GUI",
+                                           "Data augmentation:",
+                                           items, 0 if self.model.augment else 1, False)
+        if not ok:
+            return
+        epochs, ok = QInputDialog.getInt(self, "MNIST GUI",
+                                         "Epochs:",
+                                         self.model.epochs, 1, 1000, 1)
+        if not ok:
+            return
+        checkpoint_batches, ok = QInputDialog.getInt(self, "MNIST GUI",
+                                                     "Checkpoint every N batches (0 = each epoch only):",
+                                                     self.model.checkpoint_batches, 0, 100000, 10)
+        if not ok:
+            return
+        time_budget, ok = QInputDialog.getDouble(self, "MNIST GUI",
+                                                 "Time budget in seconds (0 = none):",
+                                                 self.model.time_budget_seconds or 0,
+                                                 0, 86400, 0)
+        if not ok:
+            return
+        target_f1, ok = QInputDialog.getDouble(self, "MNIST GUI",
+                                               "Target F1 score (0 = none):",
+                                               self.model.target_f1 or 0, 0, 1, 4)
+        if not ok:
+            return
+        snapshot_batches, ok = QInputDialog.getInt(self, "MNIST GUI",
+                                                   "Update prediction every N batches:",
+                                                   self.model.snapshot_batches, 1, 10000, 1)
+        if not ok:
+            return
+        snapshot_interval_ms, ok = QInputDialog.getInt(self, "MNIST GUI",
+                                                       "Update prediction every T ms:",
+                                                       self.model.snapshot_interval_ms,
+                                                       1, 600000, 100)
+        if not ok:
+            return
+        try:
+            self.model.set_training_config(batch_size, prefetch_depth,
+                                           augment=(augment == "on"),
+                                           snapshot_batches=snapshot_batches,
+                                           snapshot_interval_ms=snapshot_interval_ms,
+                                           epochs=epochs,
+                                           checkpoint_batches=checkpoint_batches,
+                                           time_budget_seconds=time_budget,
+                                           target_f1=target_f1)
+        except RuntimeError as e:
+            global_one_line_info.send(str(e))
+
+    def inferenceBackend(self):
+        backends = list(inference_backends)
+        backend, ok = QInputDialog.getItem(self, "MNIST GUI",
+                                           "Inference backend:",
+                                           backends,
+                                           backends.index(self.model.inference_backend), False)
+        if not ok:
+            return
+        try:
+            self.model.set_inference_backend(backend)
+            self.HandWriting.scribbleArea.outputAcc()
+        except RuntimeError as e:
+            global_one_line_info.send(str(e))
+
+    def quantizationReport(self):
+        global_one_line_info.send("int8 に量子化したモデルを評価中...")
+        threading.Thread(target=self._runQuantizationReport, daemon=True).start()
+
+    def _runQuantizationReport(self):
+        try:
+            report = self.model.quantization_report()
+        except RuntimeError as e:
+            self.model.info_signal.emit(str(e))
+            return
+        self.model.log("quantization report\n" + json.dumps(report, indent=2))
+        self.model.info_signal.emit("int8: F1 {:+.4f} / {:.3f} ms (keras {:.3f} ms)"
+                                    " / saved file {:.1f}x smaller"
+                                    .format(report["f1_delta"], report["latency_ms"]["int8"],
+                                            report["latency_ms"]["keras"],
+                                            report["model_bytes"]["float32"]
+                                            / report["model_bytes"]["int8_saved"]))
+
+    def cacheInfo(self):
+        global_one_line_info.send(self.model.prediction_cache.info() + " / "
+                                  + self.model.checkpoint_info() + " / "
+                                  + self.model.thread_info())
+
     def about(self):
         QMessageBox.about(self, "About MNIST GUI",
                           "<p>The <b>MNIST GUI</b> provides hand-drawing tests.")
@@ -168,6 +340,21 @@ class MainWindow(QMainWindow):
         self.penWidthAct = QAction("Pen &Width...", self,
                                    triggered=self.penWidth)
 
+        self.predictionModeAct = QAction("Prediction &Mode...", self,
+                                         triggered=self.predictionMode)
+
+        self.trainingSettingsAct = QAction("&Training Settings...", self,
+                                           triggered=self.trainingSettings)
+
+        self.inferenceBackendAct = QAction("&Inference Backend...", self,
+                                           triggered=self.inferenceBackend)
+
+        self.quantizationReportAct = QAction("&Quantization Report", self,
+                                             triggered=self.quantizationReport)
+
+        self.cacheInfoAct = QAction("Prediction Cache &Statistics", self,
+                                    triggered=self.cacheInfo)
+
         self.clearScreenAct = QAction("&Clear Screen", self, shortcut="Space",
                                       triggered=self.HandWriting.scribbleArea.clearImage)
 
@@ -185,6 +372,11 @@ class MainWindow(QMainWindow):
         optionMenu = QMenu("&Options", self)
         optionMenu.addAction(self.penColorAct)
         optionMenu.addAction(self.penWidthAct)
+        optionMenu.addAction(self.predictionModeAct)
+        optionMenu.addAction(self.trainingSettingsAct)
+        optionMenu.addAction(self.inferenceBackendAct)
+        optionMenu.addAction(self.quantizationReportAct)
+        optionMenu.addAction(self.cacheInfoAct)
         optionMenu.addSeparator()
         optionMenu.addAction(self.clearScreenAct)
 
@@ -225,6 +417,8 @@ if __name__ == '__main__':
     import sys
 
     app = QApplication(sys.argv)
-    window = MainWindow()
+    with startup_trace.phase("create window"):
+        window = MainWindow()
     window.show()
+    startup_trace.mark("window shown")
     sys.exit(app.exec_())
@@ -1,192 +1,150 @@
-from PyQt5.QtGui import QTextCursor
-
-import numpy as np
 import threading
-import copy
-import tensorflow as tf
 
-from keras.models import Sequential
-from keras.layers.core import Dense, Activation, Flatten, Dropout
-from keras.layers.convolutional import Convolution2D, MaxPooling2D
-from keras.layers.normalization import BatchNormalization
-from keras.optimizers import SGD, Adam
-from keras.models import load_model
-from keras.callbacks import LambdaCallback
+from PyQt5.QtCore import QObject, pyqtSignal
 
-import sklearn.metrics
-from sklearn import datasets
-from sklearn.model_selection import train_test_split
+import thread_tuning
+from mnist_core import MnistCore
+from one_line_info import global_one_line_info
+from training_telemetry import format_summary
 
-from PyQt5.QtCore import QObject, pyqtSignal
 
-default_model_path = './model.hdf5'
+def format_budget_report(report):
+    budget = report["budget"]
+    text = "stop: {} / {:.1f} s / {:.0f} samples/s".format(budget["stop_reason"] or "epochs",
+                                                          report["seconds"],
+                                                          report["samples_per_second"])
+    if budget["time_to_target"] is not None:
+        text += " / time to target {:.1f} s".format(budget["time_to_target"])
+    return text
 
 
-class MnistModel(threading.Thread, QObject):
+class MnistModel(MnistCore, threading.Thread, QObject):
+    """
+    MnistCore を GUI から使うためのクラス
+
+    データセットとモデルの準備と学習は時間がかかるので、このスレッドで実行する。
+    準備が終わると ready_signal を送る。
+    スレッド数をまだ計測していなければ、準備が終わってから学習を待つ前にこのスレッドで計測する。
+    ログは QTextBrowser に、進捗は QProgressBar に出力する。
+    ほかのスレッドからはウィジェットに直接触れず、シグナルで GUI のスレッドに送る。
+    """
     progress_signal = pyqtSignal(int)
+    log_signal = pyqtSignal(str)
+    telemetry_signal = pyqtSignal(object)
+    # ほかのスレッドからステータスバーに表示するためのシグナル
+    info_signal = pyqtSignal(str)
+    ready_signal = pyqtSignal()
 
     def __init__(self, logger, progress):
         threading.Thread.__init__(self)
         QObject.__init__(self)
         self.logger = logger
         self.progress_signal.connect(progress.setValue)
+        self.log_signal.connect(logger.append)
+        self.telemetry_signal.connect(self._show_telemetry)
+        self.info_signal.connect(self._send_info)
 
         self.learn_event = threading.Event()
         self.learn_event.clear()
+        # 次の学習をチェックポイントから再開するかどうか。start_learning で指定する
+        self._resume = False
         self._exit = False
-        self._is_learning = False
 
-        self.mnist = datasets.fetch_mldata('MNIST original', data_home='.')
-        self.X_train = None
-        self.Y_train = None
-        self.X_test = None
-        self.Y_test = None
-        self._set_train_and_test_data()
+        self.update_bar_func = None
+        # 準備は run の最初に行うので、ウィンドウはすぐに表示できる
+        # ./model.hdf5 がなければ既定のモデルを使う
+        MnistCore.__init__(self, lazy=True)
 
-        self.model = None
-        try:
-            self.load(default_model_path)
-        except:
-            self.set_model()
-        self.graph = tf.get_default_graph()
+    def log(self, text):
+        self.log_signal.emit(text)
 
-        self.update_bar_func = None
-        self.model_creator = None
+    def on_progress(self, percent):
+        self.progress_signal.emit(int(percent))
 
-    def _set_train_and_test_data(self):
-        np.random.seed(0)
-        n = len(self.mnist.data)
-        indices = np.random.permutation(range(n))[:n]
+    def on_telemetry(self, summary):
+        self.telemetry_signal.emit(summary)
 
-        x = self.mnist.data[indices]
-        x = x.reshape(-1, 28, 28, 1)
-        y = self.mnist.target[indices]
-        y = np.eye(10)[y.astype(int)]  # 1-of-K 表現に変換
+    def _show_telemetry(self, summary):
+        self.progress_signal.emit(int(summary["percent"]))
+        global_one_line_info.send(format_summary(summary))
 
-        self.X_train, self.X_test, self.Y_train, self.Y_test \
-            = train_test_split(x, y, test_size=0.2)
+    def _send_info(self, text):
+        global_one_line_info.send(text)
 
-    def load(self, path):
-        if self._is_learning:
-            raise RuntimeError("学習中なのでモデルのロードはできません。")
-        else:
-            self.model = load_model(path)
-        self.model_creator = None
+    def on_startup_phase(self, name):
+        self.info_signal.emit("準備中: {} ...".format(name))
+
+    def on_ready(self):
+        self.ready_signal.emit()
 
-    def save(self, path):
-        if self._is_learning:
-            raise RuntimeError("学習中なので、モデルはセーブできません。")
+    def on_model_loaded(self, path, seconds, error):
+        super(MnistModel, self).on_model_loaded(path, seconds, error)
+        if error is None:
+            self.info_signal.emit("モデルをロードしました。({:.3f} 秒)".format(seconds))
         else:
-            self.model.save(path)
+            self.info_signal.emit("モデルをロードできませんでした。" + str(error))
+        if self.update_bar_func is not None:
+            self.update_bar_func()
 
     def set_update_bar_func(self, update_bar_func):
         """ユーザーが描いた手書き数字の認識をアップデートする"""
         self.update_bar_func = update_bar_func
 
+    def on_snapshot_published(self):
+        if self.update_bar_func is not None:
+            self.update_bar_func()
+
+    def start_learning(self, resume=False):
+        """
+        学習を始める。
+
+        :param resume: 途中で止まった学習のチェックポイントから再開する
+        """
+        self._resume = resume
+        self.learn_event.set()
+
     def run(self):
-        """学習を実行する。時間がかかるのでマルチスレッド化してある。"""
+        """準備をしてから、学習を実行する。時間がかかるのでマルチスレッド化してある。"""
+        try:
+            self.initialize()
+        except Exception as e:
+            self.log("準備に失敗しました。" + str(e))
+            self.info_signal.emit("準備に失敗しました。" + str(e))
+            return
+        if not self.thread_profile["tuned"]:
+            self._tune_threads_after_ready()
         while True:
             self.learn_event.wait()
             if self._exit:
                 break
-            self._is_learning = True
-            epochs = 1
-            batch_size = 1000
-            num_batch = len(self.X_train) // batch_size
-            if self.model is None:
-                self.logger.append("no model")
-                return
-
-            self.progress_signal.emit(0)
-            self.logger.append("start learning")
-
-            def batch_end_out(epoch, logs):
-                self.progress_signal.emit((epoch + 1) / num_batch * 100)
-                # self.logger.append(str("{}/{} {:.4f}".format(epoch + 1,
-                #                                              num_batch,
-                #                                              logs['acc'])))
-                # self.logger.moveCursor(QTextCursor.End)
-                if self.update_bar_func is not None:
-                    self.update_bar_func()
-
-            def epoch_end_out(epoch, logs):
-                pass
-                # self.logger.append(str(logs))
-                # self.logger.moveCursor(QTextCursor.End)
-
-            with self.graph.as_default():
-                self.model.fit(self.X_train, self.Y_train,
-                               validation_data=(self.X_test, self.Y_test),
-                               epochs=epochs,
-                               batch_size=batch_size,
-                               callbacks=[LambdaCallback(on_batch_end=batch_end_out,
-                                                         on_epoch_end=epoch_end_out)])
-
-            self.logger.append("end learning")
-            self.logger.append(str(self.report_evaluation()))
-            self._is_learning = False
+            try:
+                # 再開するのは、ユーザーが再開を選んだときだけ
+                report = self.train(resume=self._resume)
+                if "budget" in report:
+                    self.log(format_budget_report(report))
+                self.log(str(self.report_evaluation()))
+            except RuntimeError as e:
+                self.log(str(e))
             if self._exit:
                 break
             self.learn_event.clear()
             if self._exit:
                 break
 
-    def is_learning(self):
-        return self._is_learning
-
-    def stop_learning(self):
-        self.model.stop_training = True
+    def _tune_threads_after_ready(self):
+        """計測した設定は保存して、次の起動から使う。学習を始めても、計測が終わるまで待つ。"""
+        self.info_signal.emit("スレッド数を計測しています ...")
+        try:
+            profile = self.tune_threads()
+        except Exception as e:
+            # 保存しないので、次の起動で計測し直す
+            self.info_signal.emit("スレッド数を計測できませんでした。" + str(e))
+            return
+        self.log(thread_tuning.format_profile(profile))
+        self.info_signal.emit("スレッド数を計測しました。次の起動から使います。")
 
     def kill(self):
-        if self.model is None:
-            return
-        self.model.stop_training = True
+        if self.model is not None:
+            self.model.stop_training = True
         self._exit = True
         self.learn_event.set()
-
-    def predict(self, image):
-        if self.model is None:
-            return
-        return self.model.predict(image).reshape(10)
-
-    def set_model(self, model=None, model_creator=None):
-        if self._is_learning:
-            raise RuntimeError("学習中なので、モデルの設定はできません。")
-        if model is None:
-            self.model = Sequential()
-
-            self.model.add(Convolution2D(15,
-                                         (3, 3),
-                                         input_shape=(28, 28, 1),
-                                         activation='relu'))
-            self.model.add(MaxPooling2D())
-            self.model.add(Convolution2D(15,
-                                         (3, 3),
-                                         activation='relu'))
-            self.model.add(MaxPooling2D())
-            self.model.add(Flatten())
-
-            self.model.add(BatchNormalization())
-
-            self.model.add(Dense(200))
-
-            self.model.add(Dropout(0.5))
-
-            self.model.add(Dense(10))
-            self.model.add(Activation('softmax'))
-
-            self.model.compile(loss='categorical_crossentropy',
-                               optimizer=Adam(lr=0.01),
-                               metrics=['accuracy'])
-            self.model_creator = None
-        else:
-            self.model = model
-            self.model_creator = copy.copy(model_creator)
-
-    def report_evaluation(self):
-        with self.graph.as_default():
-            y = self.model.predict(self.X_test)
-            y_pred = [np.argmax(onehot) for onehot in y]
-            y_true = [np.argmax(onehot) for onehot in self.Y_test]
-            # return sklearn.metrics.classification_report(y_true, y_pred)
-            return float(sklearn.metrics.f1_score(y_true, y_pred, average='weighted'))
@@ -1,9 +1,38 @@
-from keras.models import Sequential
-from keras.layers import Dense, Activation, Dropout, Flatten
-from keras.layers import Conv2D, MaxPool2D
-from keras.layers import BatchNormalization
+import hashlib
+import json
+import time
+
+# keras は読み込みに時間がかかるので、モデルを構築するときに読み込む。
+# 層の編集だけなら keras は必要ない
 from one_line_info import global_one_line_info
 
+
+# add_compile で受け付けるモデルの大きさの上限。None なら制限しない
+default_flops_budget = 200 * 10 ** 6
+default_memory_budget = 256 * 2 ** 20
+
+
+def _prod(shape):
+    n = 1
+    for v in shape:
+        n *= v
+    return n
+
+
+def format_count(n):
+    for unit, scale in (("G", 10 ** 9), ("M", 10 ** 6), ("k", 10 ** 3)):
+        if n >= scale:
+            return "{:.1f}{}".format(n / scale, unit)
+    return str(n)
+
+
+def format_bytes(n):
+    for unit, scale in (("GB", 2 ** 30), ("MB", 2 ** 20), ("KB", 2 ** 10)):
+        if n >= scale:
+            return "{:.1f} {}".format(n / scale, unit)
+    return "{} B".format(n)
+
+
 class LayerBase:
     def __init__(self):
         self.output_shape = ()
@@ -11,8 +40,25 @@ class LayerBase:
     def get_output_shape(self):
         return self.output_shape
 
-    def get_code(self):
-        return ""
+    def build(self, model):
+        """keras のモデルにこの層を追加する"""
+        pass
+
+    def to_dict(self):
+        """ModelCreator.from_json で復元するための dict。自動で追加される層は None"""
+        return None
+
+    def param_count(self):
+        """パラメータの数"""
+        return 0
+
+    def flops(self):
+        """１サンプルあたりの積和演算の回数"""
+        return 0
+
+    def activation_bytes(self):
+        """１サンプルあたりの出力のサイズ (float32)"""
+        return _prod(self.output_shape) * 4
 
 
 class DenseLayer(LayerBase):
@@ -23,10 +69,18 @@ class DenseLayer(LayerBase):
         self.units = units
         self.output_shape = (units,)
 
-    def get_code(self):
-        return "model.add(Dense({}, input_shape={})); " \
-            .format(self.units,
-                    str(self.input_shape))
+    def build(self, model):
+        from keras.layers import Dense
+        model.add(Dense(self.units, input_shape=self.input_shape))
+
+    def to_dict(self):
+        return {"type": "dense", "units": self.units}
+
+    def param_count(self):
+        return self.input_shape[0] * self.units + self.units
+
+    def flops(self):
+        return self.input_shape[0] * self.units
 
 
 class ActivationLayer(LayerBase):
@@ -38,10 +92,12 @@ class ActivationLayer(LayerBase):
         self.func_name = func_name
         self.output_shape = input_shape
 
-    def get_code(self):
-        return "model.add(Activation('{}', input_shape={})); "\
-               .format(self.func_name,
-                       str(self.input_shape))
+    def build(self, model):
+        from keras.layers import Activation
+        model.add(Activation(self.func_name, input_shape=self.input_shape))
+
+    def to_dict(self):
+        return {"type": "activation", "func_name": self.func_name}
 
     @staticmethod
     def get_func_set():
@@ -64,9 +120,12 @@ class DropoutLayer(LayerBase):
         self.output_shape = input_shape
         self.r_str = r_str
 
-    def get_code(self):
-        return "model.add(Dropout({})); "\
-               .format(self.r_str)
+    def build(self, model):
+        from keras.layers import Dropout
+        model.add(Dropout(float(self.r_str)))
+
+    def to_dict(self):
+        return {"type": "dropout", "ratio": self.r_str}
 
 
 class FlattenLayer(LayerBase):
@@ -77,9 +136,13 @@ class FlattenLayer(LayerBase):
         self.input_shape = input_shape
         self.output_shape = (dim,)
 
-    def get_code(self):
-        return "model.add(Flatten(input_shape={})); " \
-               .format(str(self.input_shape))
+    def build(self, model):
+        from keras.layers import Flatten
+        model.add(Flatten(input_shape=self.input_shape))
+
+    def activation_bytes(self):
+        # 形を変えるだけで、新しくメモリは使わない
+        return 0
 
 
 class Conv2dLayer(LayerBase):
@@ -103,11 +166,18 @@ class Conv2dLayer(LayerBase):
         self.kernel = (kernel_x, kernel_y)
         self.output_shape = (output_x, output_y, filters)
 
-    def get_code(self):
-        return "model.add(Conv2D({}, {}, input_shape={})); " \
-                .format(self.filters,
-                        str(self.kernel),
-                        str(self.input_shape))
+    def build(self, model):
+        from keras.layers import Conv2D
+        model.add(Conv2D(self.filters, self.kernel, input_shape=self.input_shape))
+
+    def to_dict(self):
+        return {"type": "conv2d", "filters": self.filters, "kernel": list(self.kernel)}
+
+    def param_count(self):
+        return self.kernel[0] * self.kernel[1] * self.input_shape[2] * self.filters + self.filters
+
+    def flops(self):
+        return _prod(self.output_shape) * self.kernel[0] * self.kernel[1] * self.input_shape[2]
 
 
 class MaxPool2dLayer(LayerBase):
@@ -128,10 +198,12 @@ class MaxPool2dLayer(LayerBase):
         self.pool_size = (pool_x, pool_y)
         self.output_shape = (output_x, output_y, input_shape[2])
 
-    def get_code(self):
-        return "model.add(MaxPool2D({}, input_shape={})); " \
-                .format(str(self.pool_size),
-                        str(self.input_shape))
+    def build(self, model):
+        from keras.layers import MaxPool2D
+        model.add(MaxPool2D(self.pool_size, input_shape=self.input_shape))
+
+    def to_dict(self):
+        return {"type": "max_pool2d", "pool_size": list(self.pool_size)}
 
 
 class BatchNormalizationLayer(LayerBase):
@@ -139,9 +211,19 @@ class BatchNormalizationLayer(LayerBase):
         self.input_shape = input_shape
         self.output_shape = input_shape
 
-    def get_code(self):
-        return "model.add(BatchNormalization(input_shape={})); "\
-               .format(str(self.input_shape))
+    def build(self, model):
+        from keras.layers import BatchNormalization
+        model.add(BatchNormalization(input_shape=self.input_shape))
+
+    def to_dict(self):
+        return {"type": "batch_normalization"}
+
+    def param_count(self):
+        # gamma, beta, moving_mean, moving_variance
+        return 4 * self.input_shape[-1]
+
+    def flops(self):
+        return _prod(self.output_shape)
 
 
 class InputLayer(LayerBase):
@@ -149,9 +231,6 @@ class InputLayer(LayerBase):
         self.input_shape = input_shape
         self.output_shape = input_shape
 
-    def get_code(self):
-        return ""
-
 
 class CompileLayer(LayerBase):
     def __init__(self, input_shape):
@@ -160,8 +239,14 @@ class CompileLayer(LayerBase):
         self.input_shape = input_shape
         self.output_shape = input_shape
 
-    def get_code(self):
-        return "model.compile(loss='categorical_crossentropy', optimizer='SGD', metrics=['acc']);"
+    def build(self, model):
+        model.compile(loss='sparse_categorical_crossentropy', optimizer='SGD', metrics=['acc'])
+
+    def to_dict(self):
+        return {"type": "compile"}
+
+    def activation_bytes(self):
+        return 0
 
 
 class ModelCreator(object):
@@ -181,6 +266,8 @@ class ModelCreator(object):
         self.model_structure = None
         self.is_compiled = None
         self.is_last_layer_softmax = None
+        self.flops_budget = default_flops_budget
+        self.memory_budget = default_memory_budget
         self.clear()
         pass
 
@@ -227,9 +314,45 @@ class ModelCreator(object):
     def add_batch_normalization(self):
         self._add_layer(BatchNormalizationLayer(self.shape))
 
+    def total_params(self):
+        return sum(layer.param_count() for layer in self.model_structure)
+
+    def total_flops(self):
+        return sum(layer.flops() for layer in self.model_structure)
+
+    def total_activation_bytes(self):
+        return sum(layer.activation_bytes() for layer in self.model_structure)
+
+    def memory_bytes(self):
+        """１サンプルあたりのメモリの見積もり (パラメータと各層の出力, float32)"""
+        return self.total_params() * 4 + self.total_activation_bytes()
+
+    def set_budget(self, flops=None, memory_bytes=None):
+        """add_compile で受け付けるモデルの大きさの上限を設定する。None なら制限しない"""
+        self.flops_budget = flops
+        self.memory_budget = memory_bytes
+
+    def check_budget(self):
+        """モデルが大きすぎる場合は RuntimeError を投げる。TensorFlow は使わない"""
+        flops = self.total_flops()
+        if self.flops_budget is not None and flops > self.flops_budget:
+            raise RuntimeError("演算量 {} MACs が上限 {} MACs を超えています。"
+                               .format(format_count(flops), format_count(self.flops_budget)))
+        memory = self.memory_bytes()
+        if self.memory_budget is not None and memory > self.memory_budget:
+            raise RuntimeError("メモリ {} が上限 {} を超えています。"
+                               .format(format_bytes(memory), format_bytes(self.memory_budget)))
+
+    def get_cost_summary(self):
+        return "Total\n  params {}\n  MACs {}\n  memory {}"\
+            .format(format_count(self.total_params()),
+                    format_count(self.total_flops()),
+                    format_bytes(self.memory_bytes()))
+
     def add_compile(self):
         if self.is_compiled:
             raise RuntimeError("コンパイルする必要はありません。")
+        self.check_budget()
         layer = CompileLayer(self.shape)
         if not self.is_last_layer_softmax:
             self.add_activation("softmax")
@@ -254,18 +377,67 @@ class ModelCreator(object):
             self.delete_last_layer()
         self.call_notify_func()
 
+    def structure_hash(self):
+        return hashlib.sha256(self.to_json().encode()).hexdigest()
+
     def get_model(self):
+        """
+        新しく構築した keras のモデルを返し、構築にかかった時間をステータスバーに表示する。
+
+        呼ぶたびに新しいモデルを返すので、以前に返したモデルの重みは変わらない。
+        (構築済みのモデルを使い回すと、渡したモデルの重みを初期化してしまうので使い回さない)
+        """
         if not self.is_compiled:
             raise RuntimeError("モデルがコンパイルされていません。")
-        code = ""
-        for layer in self.model_structure:
-            code += layer.get_code()
-        print(code)
+        begin = time.perf_counter()
+        model = self.build_model()
+        global_one_line_info.send("モデルを構築しました。({:.3f} 秒)"
+                                  .format(time.perf_counter() - begin))
+        return model
+
+    def build_model(self):
+        """
+        キャッシュを使わずに、新しく keras のモデルを構築する。
+
+        現在のグラフに構築するので、別のグラフに作りたいときは呼び出す側でグラフを切り替える。
+        """
+        if not self.is_compiled:
+            raise RuntimeError("モデルがコンパイルされていません。")
+        from keras.models import Sequential
         model = Sequential()
-        exec(code)
-        model.summary()
+        for layer in self.model_structure:
+            layer.build(model)
         return model
 
+    def to_json(self):
+        """編集した層のリストを JSON の文字列にする"""
+        layers = [layer.to_dict() for layer in self.model_structure]
+        return json.dumps([layer for layer in layers if layer is not None])
+
+    @staticmethod
+    def from_json(text):
+        """to_json で作った文字列から、ModelCreator を復元する"""
+        creator = ModelCreator()
+        for layer in json.loads(text):
+            layer_type = layer["type"]
+            if layer_type == "dense":
+                creator.add_dense(layer["units"])
+            elif layer_type == "activation":
+                creator.add_activation(layer["func_name"])
+            elif layer_type == "dropout":
+                creator.add_dropout(layer["ratio"])
+            elif layer_type == "conv2d":
+                creator.add_conv2d(layer["filters"], *layer["kernel"])
+            elif layer_type == "max_pool2d":
+                creator.add_max_pool2d(*layer["pool_size"])
+            elif layer_type == "batch_normalization":
+                creator.add_batch_normalization()
+            elif layer_type == "compile":
+                creator.add_compile()
+            else:
+                raise RuntimeError("層 {} はサポートしていません。".format(layer_type))
+        return creator
+
     def set_changed_notify(self, func):
         self.changed_notify_func = func
 
@@ -273,7 +445,7 @@ class ModelCreator(object):
         if self.changed_notify_func is not None:
             self.changed_notify_func()
 
-    def get_str_list(self):
+    def get_str_list(self, profile=None):
         """
         文字列のリストを返す。
         例:
@@ -283,7 +455,9 @@ class ModelCreator(object):
               (26, 26, 10)
         [2] Conv2D (3, 3) x 10
               (24, 24, 10)
+              params 910 / MACs 518.4k / act 22.5 KB
 
+        :param profile: model_profiler.profile の結果。あれば層ごとの実測時間も表示する
         :return: [層の文字列, ...]
         """
         str_list = list()
@@ -294,7 +468,17 @@ class ModelCreator(object):
         def add_shape(shape):
             str_list[-1] += "\n  " + str(shape)
 
-        for layer in self:
+        def add_cost(layer):
+            str_list[-1] += "\n  params {} / MACs {} / act {}"\
+                .format(format_count(layer.param_count()),
+                        format_count(layer.flops()),
+                        format_bytes(layer.activation_bytes()))
+
+        forward_ms = dict()
+        if profile is not None:
+            forward_ms = {row["index"]: row["forward_ms"] for row in profile["layers"]}
+
+        for index, layer in enumerate(self):
             if isinstance(layer, DenseLayer):
                 append("Dense")
                 add_shape(layer.output_shape)
@@ -326,5 +510,9 @@ class ModelCreator(object):
             else:
                 append("unknown layer")
                 add_shape(layer.output_shape)
+            if not isinstance(layer, (FlattenLayer, CompileLayer)):
+                add_cost(layer)
+                if index in forward_ms:
+                    str_list[-1] += "\n  forward {:.3f} ms".format(forward_ms[index])
 
         return str_list
@@ -2,6 +2,8 @@ from PyQt5.QtCore import *
 from PyQt5.QtGui import *
 from PyQt5.QtWidgets import *
 
+import threading
+
 from layer_editor_widgets import *
 from model_creator import *
 from one_line_info import global_one_line_info
@@ -48,9 +50,24 @@ class ModelDisplayWidget(QListWidget):
         self.setFocusPolicy(Qt.NoFocus)
 
         self.model_creator = model_creator
+        self.profile = None
+
+    def set_profile(self, profile):
+        self.profile = profile
+        self.update_notify()
 
     def update_notify(self):
-        str_list = self.model_creator.get_str_list()
+        # 構造が変わったら、以前の計測結果は表示しない
+        profile = self.profile
+        if profile is not None and (not self.model_creator.is_compiled or
+                                    profile["structure_hash"] != self.model_creator.structure_hash()):
+            profile = None
+        str_list = self.model_creator.get_str_list(profile)
+        str_list.append(self.model_creator.get_cost_summary())
+        if profile is not None:
+            str_list.append("forward {:.3f} ms / train step {:.3f} ms (batch {})"
+                            .format(profile["forward_ms"], profile["train_step_ms"],
+                                    profile["batch_size"]))
         self.clear()
         self.addItems(str_list)
 
@@ -59,6 +76,8 @@ class ModelEditorWidget(QWidget):
     """
     モデルエディタータブの内容を表すウィジェット
     """
+    profile_finished = pyqtSignal(object)
+
     def __init__(self, model, parent=None):
         super(ModelEditorWidget, self).__init__()
         self.model = model
@@ -69,6 +88,9 @@ class ModelEditorWidget(QWidget):
         self.evaluate_btn.clicked.connect(self.evaluate_model)
         self.load_from_editor_btn = QPushButton("エディターからモデルをロード", self)
         self.load_from_editor_btn.clicked.connect(self.load_from_editor)
+        self.profile_btn = QPushButton("エディターのモデルをプロファイル", self)
+        self.profile_btn.clicked.connect(self.profile_model)
+        self.profile_finished.connect(self.show_profile)
         self.reset_editor_model_btn = QPushButton("エディターのモデルを初期化", self)
         self.reset_editor_model_btn.clicked.connect(self.reset_editor_model)
         self.layer_editor = LayerEditorWidget(self.model_creator, self)
@@ -90,18 +112,24 @@ class ModelEditorWidget(QWidget):
 
         self.reset_editor_model_btn.move(356, self.height() * 0.35)
         self.load_from_editor_btn.move(356, self.height() * 0.4)
+        self.profile_btn.move(356, self.height() * 0.45)
 
         self.model_display.move(356, self.height() * 0.5)
         self.model_display.resize(200, self.height() * 0.45)
 
     def load_defo(self):
         try:
-            self.model.load(default_model_path)
+            # ロードが終わるまで以前のモデルで予測を続ける
+            self.model.load_async(default_model_path)
+            global_one_line_info.send("モデルをロード中...")
         except RuntimeError as e:
             global_one_line_info.send(str(e))
 
     def evaluate_model(self):
-        global_one_line_info.send(str(self.model.report_evaluation()))
+        result = self.model.evaluate()
+        global_one_line_info.send(str(result["f1_score"]))
+        self.model.log("confusion matrix (row: true, column: predicted)\n"
+                       + str(result["confusion_matrix"]))
 
     def load_from_editor(self):
         try:
@@ -113,5 +141,38 @@ class ModelEditorWidget(QWidget):
         except RuntimeError as e:
             global_one_line_info.send(str(e))
 
+    def profile_model(self):
+        """エディターのモデルの層ごとの実行時間を、別のスレッドで計測する"""
+        if not self.model_creator.is_compiled:
+            global_one_line_info.send("モデルがコンパイルされていません。")
+            return
+        # 計測中に編集されても影響しないように、複製したモデルで計測する。
+        # from_json はステータスバーに表示するので、GUI のスレッドで複製する
+        model_creator = ModelCreator.from_json(self.model_creator.to_json())
+        self.profile_btn.setEnabled(False)
+        global_one_line_info.send("プロファイル中...")
+        threading.Thread(target=self._run_profile,
+                         args=(model_creator, self.model.batch_size)).start()
+
+    def _run_profile(self, model_creator, batch_size):
+        """別のスレッドで実行する。結果は profile_finished で GUI のスレッドに送る"""
+        import model_profiler
+        try:
+            result = model_profiler.profile(model_creator, batch_size)
+        except Exception as e:
+            result = e
+        self.profile_finished.emit(result)
+
+    def show_profile(self, result):
+        import model_profiler
+        self.profile_btn.setEnabled(True)
+        if isinstance(result, Exception):
+            global_one_line_info.send("プロファイルに失敗しました。" + str(result))
+            return
+        self.model_display.set_profile(result)
+        model_profiler.save(result)
+        global_one_line_info.send("プロファイルの結果を {} に保存しました。"
+                                  .format(model_profiler.default_profile_path))
+
     def reset_editor_model(self):
         self.model_creator.clear()
@@ -0,0 +1,81 @@
+"""
+エディターで作ったモデルの、層ごとの実行時間を計測する
+
+    model_creator.get_cost_summary() は計算量の見積もりだけなので、
+    実際にどの層が遅いのかはこちらで確かめる。
+
+計測は別のグラフとセッションで行うので、学習中や予測に使っているモデルには影響しない。
+"""
+import json
+import time
+
+import numpy as np
+import tensorflow as tf
+from keras import backend as K
+from model_creator import InputLayer, CompileLayer
+
+default_profile_path = './model_profile.json'
+default_repeat = 10
+
+
+def _median_seconds(func, repeat, warmup=2):
+    for _ in range(warmup):
+        func()
+    seconds = []
+    for _ in range(repeat):
+        begin = time.perf_counter()
+        func()
+        seconds.append(time.perf_counter() - begin)
+    return float(np.median(seconds))
+
+
+def profile(model_creator, batch_size, repeat=default_repeat):
+    """
+    ランダムな入力で、各層の順伝播の時間と、学習１ステップ (順伝播 + 逆伝播) の時間を計測する。
+
+    層ごとの時間は、入力からその層の出力までの時間と、１つ前の層までの時間の差とする。
+
+    :param model_creator: コンパイルしてある ModelCreator
+    :param batch_size: 計測に使うバッチサイズ
+    :return: {"structure_hash", "batch_size", "forward_ms", "train_step_ms",
+              "layers": [{"index", "name", "forward_ms"}, ...]}
+              index は model_creator の層の番号
+    """
+    if not model_creator.is_compiled:
+        raise RuntimeError("モデルがコンパイルされていません。")
+    random = np.random.RandomState(0)
+    x = random.uniform(0, 255, size=(batch_size, 28, 28, 1)).astype(np.float32)
+    y = random.randint(0, 10, size=(batch_size,))
+
+    # keras の層は InputLayer と CompileLayer 以外の層と１対１に対応する
+    indices = [index for index, layer in enumerate(model_creator)
+               if not isinstance(layer, (InputLayer, CompileLayer))]
+
+    graph = tf.Graph()
+    with graph.as_default(), tf.Session(graph=graph).as_default() as session:
+        model = model_creator.build_model()
+        cumulative = []
+        for layer in model.layers:
+            func = K.function([model.input, K.learning_phase()], [layer.output])
+            cumulative.append(_median_seconds(lambda: func([x, 0]), repeat))
+        train_step = _median_seconds(lambda: model.train_on_batch(x, y), repeat)
+        session.close()
+
+    layers = []
+    previous = 0.0
+    for index, layer, seconds in zip(indices, model.layers, cumulative):
+        # 計測の揺らぎで負にならないようにする
+        layers.append({"index": index,
+                       "name": layer.__class__.__name__,
+                       "forward_ms": max(seconds - previous, 0.0) * 1000})
+        previous = max(previous, seconds)
+    return {"structure_hash": model_creator.structure_hash(),
+            "batch_size": batch_size,
+            "forward_ms": cumulative[-1] * 1000 if cumulative else 0.0,
+            "train_step_ms": train_step * 1000,
+            "layers": layers}
+
+
+def save(result, path=default_profile_path):
+    with open(path, "w") as f:
+        json.dump(result, f, indent=2)
@@ -0,0 +1,112 @@
+import hashlib
+import io
+import json
+import os
+import threading
+import time
+import zlib
+
+import numpy as np
+
+default_store_dir = "./ranking_data/store"
+
+
+class ModelStore:
+    """
+    ランキングに登録されたモデルを、内容のハッシュをキーにして保存するクラス
+
+    モデルの構造 (ModelCreator.to_json) と重みのテンソルは、それぞれ１度だけ保存する。
+    同じ構造や同じ重みを持つモデルが何度登録されても、増えるのはマニフェストだけになる。
+    マニフェストは構造と重みのハッシュのリストで、それ自体のハッシュがモデルの参照になる。
+    """
+    def __init__(self, root=default_store_dir):
+        self.root = root
+        self._lock = threading.Lock()
+        os.makedirs(os.path.join(root, "blobs"), exist_ok=True)
+
+    def _blob_path(self, key):
+        return os.path.join(self.root, "blobs", key[:2], key[2:])
+
+    def _put_blob(self, data, stats=None):
+        """
+        data を圧縮して保存し、ハッシュを返す。すでにあれば何もしない。
+
+        :param stats: 渡すと "bytes" (data の大きさ) と "written_bytes" (書き込んだ大きさ) に足す
+        """
+        key = hashlib.sha256(data).hexdigest()
+        path = self._blob_path(key)
+        if stats is not None:
+            stats["bytes"] += len(data)
+        with self._lock:
+            if os.path.exists(path):
+                return key
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            compressed = zlib.compress(data)
+            # 書き込みの途中で落ちても、壊れたファイルが残らないようにする
+            tmp_path = path + ".tmp"
+            with open(tmp_path, "wb") as f:
+                f.write(compressed)
+            os.replace(tmp_path, path)
+        if stats is not None:
+            stats["written_bytes"] += len(compressed)
+        return key
+
+    def _get_blob(self, key):
+        with open(self._blob_path(key), "rb") as f:
+            return zlib.decompress(f.read())
+
+    @staticmethod
+    def _canonical_architecture(model_creator_json):
+        # 空白や並び順が違っても、同じ構造なら同じハッシュになるようにする
+        return json.dumps(json.loads(model_creator_json), sort_keys=True,
+                          separators=(",", ":")).encode()
+
+    @staticmethod
+    def _tensor_to_bytes(tensor):
+        buffer = io.BytesIO()
+        np.save(buffer, np.ascontiguousarray(tensor), allow_pickle=False)
+        return buffer.getvalue()
+
+    def put(self, model_creator_json, weights, stats=None):
+        """
+        モデルを保存する。
+
+        :param model_creator_json: ModelCreator.to_json() の文字列
+        :param weights: keras の model.get_weights() の結果
+        :param stats: 渡すと、保存したモデルの大きさ "bytes"、重複を除いて実際に書き込んだ大きさ
+                      "written_bytes"、かかった時間 "seconds" を設定する
+        :return: モデルの参照 (マニフェストのハッシュ)
+        """
+        begin = time.perf_counter()
+        if stats is not None:
+            stats.update(bytes=0, written_bytes=0)
+        manifest = {"architecture": self._put_blob(self._canonical_architecture(model_creator_json),
+                                                   stats),
+                    "weights": [self._put_blob(self._tensor_to_bytes(w), stats) for w in weights]}
+        ref = self._put_blob(json.dumps(manifest, sort_keys=True).encode(), stats)
+        if stats is not None:
+            stats["seconds"] = time.perf_counter() - begin
+        return ref
+
+    def get(self, ref):
+        """
+        :return: (ModelCreator.to_json() の文字列, 重みのリスト)
+        """
+        manifest = json.loads(self._get_blob(ref).decode())
+        architecture = self._get_blob(manifest["architecture"]).decode()
+        weights = [np.load(io.BytesIO(self._get_blob(key)), allow_pickle=False)
+                   for key in manifest["weights"]]
+        return architecture, weights
+
+    def load_model(self, ref):
+        """
+        保存したモデルを keras のモデルとして復元する。
+
+        :return: (keras のモデル, ModelCreator)
+        """
+        from model_creator import ModelCreator
+        architecture, weights = self.get(ref)
+        model_creator = ModelCreator.from_json(architecture)
+        model = model_creator.get_model()
+        model.set_weights(weights)
+        return model, model_creator
@@ -0,0 +1,219 @@
+"""
+keras のモデルを NumPy だけで予測するためのモジュール
+
+ModelCreator で作れる層 (Conv2D, MaxPool2D, Dense, BatchNormalization, Dropout, Flatten, Activation)
+と、既定のモデルで使っている層だけに対応する。
+export には keras のモデルが必要だが、save したファイルを load して予測するときは TensorFlow を使わない。
+
+    engine = numpy_inference.export(keras_model)
+    engine.save("model.npz")
+    y = numpy_inference.load("model.npz").predict(images)   # images: (N, 28, 28, 1), 0-255
+
+quantization.QuantizedModel.save で保存した int8 のモデルも load で読み込める。
+"""
+import json
+
+import numpy as np
+from numpy.lib.stride_tricks import as_strided
+
+
+def _softmax(x):
+    e = np.exp(x - x.max(axis=-1, keepdims=True))
+    return e / e.sum(axis=-1, keepdims=True)
+
+
+def _sigmoid(x):
+    return 1 / (1 + np.exp(-x))
+
+
+_activations = {"linear": lambda x: x,
+                "relu": lambda x: np.maximum(x, 0),
+                "sigmoid": _sigmoid,
+                "tanh": np.tanh,
+                "softmax": _softmax}
+
+
+def _windows(x, size, strides):
+    """
+    (N, H, W, C) の画像から、畳み込みやプーリングの窓をコピーせずに取り出す。
+
+    :return: shape=(N, OH, OW, kh, kw, C) のビュー
+    """
+    n, h, w, c = x.shape
+    kh, kw = size
+    sh, sw = strides
+    oh = (h - kh) // sh + 1
+    ow = (w - kw) // sw + 1
+    s = x.strides
+    return as_strided(x, shape=(n, oh, ow, kh, kw, c),
+                      strides=(s[0], s[1] * sh, s[2] * sw, s[1], s[2], s[3]),
+                      writeable=False)
+
+
+def conv2d(x, kernel, bias, strides=(1, 1)):
+    """padding='valid' の畳み込み。im2col をして、１回の行列積で計算する。"""
+    kh, kw, cin, cout = kernel.shape
+    windows = _windows(np.ascontiguousarray(x), (kh, kw), strides)
+    n, oh, ow = windows.shape[:3]
+    columns = windows.reshape(n * oh * ow, kh * kw * cin)
+    y = columns @ kernel.reshape(kh * kw * cin, cout)
+    if bias is not None:
+        y += bias
+    return y.reshape(n, oh, ow, cout)
+
+
+def max_pool2d(x, pool_size, strides):
+    return _windows(np.ascontiguousarray(x), pool_size, strides).max(axis=(3, 4))
+
+
+def apply_layer(layer, x):
+    """NumpyModel の層を１つ計算する。"""
+    layer_type = layer["type"]
+    if layer_type == "conv2d":
+        x = conv2d(x, layer["kernel"], layer.get("bias"), layer["strides"])
+    elif layer_type == "dense":
+        x = x @ layer["kernel"]
+        if "bias" in layer:
+            x += layer["bias"]
+    elif layer_type == "max_pool2d":
+        x = max_pool2d(x, layer["pool_size"], layer["strides"])
+    elif layer_type == "scale_shift":
+        x = x * layer["scale"] + layer["shift"]
+    elif layer_type == "flatten":
+        x = x.reshape(len(x), -1)
+    if "activation" in layer:
+        x = _activations[layer["activation"]](x)
+    return x
+
+
+class NumpyModel:
+    """
+    keras のモデルから取り出した層のリストで、順伝播だけを行うクラス
+
+    層は {"type": 種類, ...} の dict で、重みは NumPy の配列として持つ。
+    """
+    def __init__(self, layers):
+        self.layers = layers
+
+    def predict(self, images):
+        """
+        :param images: shape=(N, 28, 28, 1) の画像 (0-255)
+        :return: shape=(N, 10) の確率
+        """
+        x = np.asarray(images, dtype=np.float32)
+        for layer in self.layers:
+            x = apply_layer(layer, x)
+        return x
+
+    def nbytes(self):
+        return sum(v.nbytes for layer in self.layers for v in layer.values()
+                   if isinstance(v, np.ndarray))
+
+    def save(self, path):
+        save_layers(path, self.layers)
+
+
+def save_layers(path, layers, kind="float32"):
+    """
+    構造を JSON に、重みを配列として１つの .npz に保存する。
+
+    :param kind: 重みの形式。"float32" なら NumpyModel、"int8" なら QuantizedModel として load する
+    """
+    spec = []
+    arrays = {}
+    for i, layer in enumerate(layers):
+        item = {}
+        for key, value in layer.items():
+            if isinstance(value, np.ndarray):
+                name = "{}_{}".format(i, key)
+                arrays[name] = value
+                item[key] = {"array": name}
+            else:
+                item[key] = value
+        spec.append(item)
+    np.savez(path, spec=np.array(json.dumps(spec)), kind=np.array(kind), **arrays)
+
+
+def load(path):
+    """save した .npz を読み込む。TensorFlow は使わない。"""
+    with np.load(path, allow_pickle=False) as data:
+        spec = json.loads(str(data["spec"]))
+        kind = str(data["kind"]) if "kind" in data.files else "float32"
+        layers = []
+        for item in spec:
+            layers.append({key: data[value["array"]] if isinstance(value, dict) else value
+                           for key, value in item.items()})
+    if kind == "int8":
+        import quantization
+        return quantization.QuantizedModel(layers)
+    return NumpyModel(layers)
+
+
+def _activation_name(config):
+    name = config.get("activation", "linear")
+    if name not in _activations:
+        raise RuntimeError("活性化関数 {} はサポートしていません。".format(name))
+    return name
+
+
+def export(model, weights=None):
+    """
+    keras のモデルを NumpyModel にする。
+
+    :param weights: model.get_weights() の結果。すでに取り出してあれば渡す
+    """
+    if weights is None:
+        weights = model.get_weights()
+    weights = [np.asarray(w, dtype=np.float32) for w in weights]
+    layers = []
+    offset = 0
+    for keras_layer in model.layers:
+        name = keras_layer.__class__.__name__
+        config = keras_layer.get_config()
+        w = weights[offset:offset + len(keras_layer.weights)]
+        offset += len(keras_layer.weights)
+        if name in ("Conv2D", "Convolution2D"):
+            if config.get("padding", "valid") != "valid" or tuple(config.get("dilation_rate", (1, 1))) != (1, 1):
+                raise RuntimeError("padding='valid' 以外の畳み込みはサポートしていません。")
+            layer = {"type": "conv2d", "kernel": w[0], "strides": list(config["strides"])}
+            if config.get("use_bias", True):
+                layer["bias"] = w[1]
+        elif name == "Dense":
+            layer = {"type": "dense", "kernel": w[0]}
+            if config.get("use_bias", True):
+                layer["bias"] = w[1]
+        elif name in ("MaxPooling2D", "MaxPool2D"):
+            if config.get("padding", "valid") != "valid":
+                raise RuntimeError("padding='valid' 以外のプーリングはサポートしていません。")
+            strides = config.get("strides") or config["pool_size"]
+            layer = {"type": "max_pool2d", "pool_size": list(config["pool_size"]),
+                     "strides": list(strides)}
+        elif name == "BatchNormalization":
+            # 予測のときは移動平均を使うので、１回の積と和にまとめられる
+            w = list(w)
+            gamma = w.pop(0) if config.get("scale", True) else None
+            beta = w.pop(0) if config.get("center", True) else None
+            mean, variance = w
+            scale = 1 / np.sqrt(variance + config["epsilon"])
+            if gamma is not None:
+                scale = scale * gamma
+            shift = -mean * scale
+            if beta is not None:
+                shift = shift + beta
+            layer = {"type": "scale_shift", "scale": scale.astype(np.float32),
+                     "shift": shift.astype(np.float32)}
+        elif name == "Flatten":
+            layer = {"type": "flatten"}
+        elif name == "Activation":
+            layer = {"type": "activation"}
+        elif name == "Dropout":
+            # 予測のときは何もしない
+            continue
+        else:
+            raise RuntimeError("層 {} はサポートしていません。".format(name))
+        if name in ("Conv2D", "Convolution2D", "Dense", "Activation"):
+            activation = _activation_name(config)
+            if activation != "linear":
+                layer["activation"] = activation
+        layers.append(layer)
+    return NumpyModel(layers)
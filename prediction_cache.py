@@ -0,0 +1,53 @@
+import collections
+import hashlib
+import threading
+
+import numpy as np
+
+
+class PredictionCache:
+    """
+    前処理後の 28x28 の入力をキーとする、予測結果の LRU キャッシュ
+
+    入力は 0-255 の整数に量子化してからハッシュする。
+    モデルが変わったときに古い結果を使わないように、キーにはモデルのバージョンも含める。
+    """
+    def __init__(self, max_size=256):
+        self.max_size = max_size
+        self._data = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def make_key(image, version):
+        quantized = np.clip(np.rint(image), 0, 255).astype(np.uint8)
+        digest = hashlib.blake2b(quantized.tobytes(), digest_size=16).digest()
+        return version, quantized.shape, digest
+
+    def get(self, key):
+        with self._lock:
+            value = self._data.get(key)
+            if value is None:
+                self.misses += 1
+                return None
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def info(self):
+        total = self.hits + self.misses
+        ratio = self.hits / total if total > 0 else 0.0
+        return "prediction cache: hits={} misses={} hit_ratio={:.3f} size={}/{}"\
+            .format(self.hits, self.misses, ratio, len(self._data), self.max_size)
@@ -0,0 +1,144 @@
+"""
+NumpyModel を int8 に量子化して予測するためのモジュール
+
+重みは出力チャンネルごとに、層への入力はテンソルごとに、対称な int8 のスケールを決める。
+入力のスケールは、実際の画像 (X_test の一部) を流したときの最大値から決める。
+
+NumPy には int8 の行列積がないので、行列積は int8 の値を float32 にして BLAS で計算する。
+値は整数なので、量子化による誤差は int8 の計算と同じになる。
+そのため予測に使うメモリは float32 のモデルとほとんど変わらない。小さくなるのは save したファイルで、
+重みは int8 で保存し、numpy_inference.load で読み込むときに float32 に戻す。
+
+    engine = quantization.quantize(numpy_inference.export(keras_model), calibration_images)
+    engine.save("model_int8.npz")
+    y = numpy_inference.load("model_int8.npz").predict(images)
+"""
+import numpy as np
+
+from numpy_inference import apply_layer, conv2d, save_layers
+
+default_calibration_size = 256
+
+
+def _quantize_weights(kernel):
+    """出力チャンネル (最後の軸) ごとに int8 にする。:return: (int8 の重み, スケール)"""
+    axes = tuple(range(kernel.ndim - 1))
+    scale = np.abs(kernel).max(axis=axes) / 127
+    scale[scale == 0] = 1
+    return np.clip(np.round(kernel / scale), -127, 127).astype(np.int8), scale.astype(np.float32)
+
+
+def _quantize_input(x, inverse_scale):
+    # 値は整数だが、行列積に BLAS を使うので float32 のままにする。１枚の予測では配列を作る回数が効くので、
+    # 丸めと切り詰めは同じ配列の上で行う
+    x_q = x * inverse_scale
+    np.rint(x_q, out=x_q)
+    np.minimum(x_q, 127, out=x_q)
+    np.maximum(x_q, -127, out=x_q)
+    return x_q
+
+
+# predict のために _prepare で作る値。保存しない
+_derived_keys = ("inverse_input_scale", "output_scale", "activation_layer")
+
+
+def _prepare(layer):
+    """保存する形の層 (int8 の重み) から、predict で使う形の層を作る。"""
+    if "input_scale" not in layer:
+        return layer
+    layer = dict(layer)
+    input_scale = np.float32(layer["input_scale"])
+    layer["input_scale"] = input_scale
+    # 値は整数なので、float32 にしても int8 と同じ値になる。int8 の重みは残さない
+    layer["kernel"] = layer["kernel"].astype(np.float32)
+    layer["inverse_input_scale"] = np.float32(1 / input_scale)
+    layer["output_scale"] = (input_scale * layer["kernel_scale"]).astype(np.float32)
+    if "activation" in layer:
+        layer["activation_layer"] = {"type": "activation", "activation": layer["activation"]}
+    return layer
+
+
+def _stored(layer):
+    """predict で使う形の層から、保存する形の層を作る。"""
+    if "input_scale" not in layer:
+        return layer
+    layer = {key: value for key, value in layer.items() if key not in _derived_keys}
+    layer["kernel"] = layer["kernel"].astype(np.int8)
+    layer["input_scale"] = float(layer["input_scale"])
+    return layer
+
+
+class QuantizedModel:
+    """
+    畳み込みと全結合の層を int8 で計算するモデル
+
+    それ以外の層は NumpyModel と同じように float32 で計算する。
+    """
+    def __init__(self, layers):
+        """:param layers: 重みが int8 の、保存する形の層のリスト"""
+        self.layers = [_prepare(layer) for layer in layers]
+        # 量子化した層への入力のスケール。量子化しない層は None
+        self.input_scales = [layer.get("input_scale") for layer in self.layers]
+
+    def predict(self, images):
+        x = np.asarray(images, dtype=np.float32)
+        for layer in self.layers:
+            if "input_scale" not in layer:
+                x = apply_layer(layer, x)
+                continue
+            x_q = _quantize_input(x, layer["inverse_input_scale"])
+            kernel = layer["kernel"]
+            if layer["type"] == "conv2d":
+                x = conv2d(x_q, kernel, None, layer["strides"])
+            else:
+                x = x_q @ kernel
+            x *= layer["output_scale"]
+            if "bias" in layer:
+                x += layer["bias"]
+            if "activation" in layer:
+                x = apply_layer(layer["activation_layer"], x)
+        return x
+
+    def nbytes(self):
+        """予測に使っているメモリの大きさ。重みは float32 で持つ"""
+        return sum(v.nbytes for layer in self.layers for v in layer.values()
+                   if isinstance(v, np.ndarray))
+
+    def saved_nbytes(self):
+        """save したときの重みの大きさ。重みは int8 で保存する"""
+        return sum(v.nbytes for layer in self.layers for v in _stored(layer).values()
+                   if isinstance(v, np.ndarray))
+
+    def save(self, path):
+        """重みを int8 で保存する。numpy_inference.load で読み込める"""
+        save_layers(path, [_stored(layer) for layer in self.layers], "int8")
+
+
+def _layer_inputs(engine, images):
+    """各層への入力の絶対値の最大値"""
+    maxima = []
+    x = np.asarray(images, dtype=np.float32)
+    for layer in engine.layers:
+        maxima.append(float(np.abs(x).max()))
+        x = apply_layer(layer, x)
+    return maxima
+
+
+def quantize(engine, calibration_images=None, input_scales=None):
+    """
+    :param engine: numpy_inference.export で作った NumpyModel
+    :param calibration_images: 入力のスケールを決めるための画像 (N, 28, 28, 1)
+    :param input_scales: 以前に量子化した QuantizedModel の input_scales。
+                         渡すと calibration_images で計算し直さない (同じ構造のモデルに限る)
+    """
+    if input_scales is None:
+        maxima = _layer_inputs(engine, calibration_images)
+        input_scales = [maximum / 127 if maximum > 0 else 1.0 for maximum in maxima]
+    layers = []
+    for layer, input_scale in zip(engine.layers, input_scales):
+        layer = dict(layer)
+        if layer["type"] in ("conv2d", "dense"):
+            layer["kernel"], layer["kernel_scale"] = _quantize_weights(layer["kernel"])
+            layer["input_scale"] = float(input_scale)
+        layers.append(layer)
+    return QuantizedModel(layers)
@@ -0,0 +1,128 @@
+import datetime
+import os
+import pickle
+import sqlite3
+import threading
+
+default_db_path = "./ranking_data/ranking.sqlite3"
+legacy_pickle_path = "./ranking_data/ranking.pickle"
+
+
+class RankingStore:
+    """
+    ランキングを SQLite に保存するクラス
+
+    登録は１行の INSERT だけで、スコアの索引を使って上位から順に取り出せる。
+    WAL モードで書き込むので、途中でアプリが落ちてもデータベースは壊れない。
+    """
+    _columns = ("id", "name", "f1_score", "model_file_name", "model_creator", "created_at",
+                "model_ref")
+
+    def __init__(self, path=default_db_path):
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        with self._lock, self._conn:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+            self._conn.execute("CREATE TABLE IF NOT EXISTS ranking ("
+                               "id INTEGER PRIMARY KEY AUTOINCREMENT, "
+                               "name TEXT NOT NULL, "
+                               "f1_score REAL NOT NULL, "
+                               "model_file_name TEXT, "
+                               "model_creator TEXT, "
+                               "created_at TEXT NOT NULL)")
+            self._conn.execute("CREATE INDEX IF NOT EXISTS ranking_f1_score "
+                               "ON ranking (f1_score DESC, id)")
+            # ModelStore に保存したモデルの参照。以前のデータベースには列がないので追加する
+            columns = [row[1] for row in self._conn.execute("PRAGMA table_info(ranking)")]
+            if "model_ref" not in columns:
+                self._conn.execute("ALTER TABLE ranking ADD COLUMN model_ref TEXT")
+
+    def insert(self, name, f1_score, model_file_name, model_creator_json, created_at=None,
+               model_ref=None):
+        """
+        :return: 登録したエントリーの id
+        """
+        if created_at is None:
+            created_at = datetime.datetime.today().isoformat()
+        with self._lock, self._conn:
+            cursor = self._conn.execute("INSERT INTO ranking "
+                                        "(name, f1_score, model_file_name, model_creator, created_at, "
+                                        "model_ref) VALUES (?, ?, ?, ?, ?, ?)",
+                                        (name, f1_score, model_file_name,
+                                         model_creator_json, created_at, model_ref))
+            return cursor.lastrowid
+
+    @staticmethod
+    def _name_condition(name_filter, table="ranking"):
+        """名前に name_filter を含むエントリーだけを選ぶ条件"""
+        if not name_filter:
+            return "1", ()
+        pattern = "%" + name_filter.replace("\\", "\\\\")\
+            .replace("%", "\\%").replace("_", "\\_") + "%"
+        return table + ".name LIKE ? ESCAPE '\\'", (pattern,)
+
+    def count(self, name_filter=None):
+        condition, params = self._name_condition(name_filter)
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM ranking WHERE " + condition,
+                                      params).fetchone()[0]
+
+    def top(self, limit, offset=0, name_filter=None):
+        """スコアの高い順に limit 件を返す。"""
+        condition, params = self._name_condition(name_filter)
+        with self._lock:
+            rows = self._conn.execute("SELECT " + ", ".join(self._columns) + " FROM ranking "
+                                      "WHERE " + condition + " "
+                                      "ORDER BY f1_score DESC, id LIMIT ? OFFSET ?",
+                                      params + (limit, offset)).fetchall()
+        return [self._to_item(row) for row in rows]
+
+    def get(self, entry_id, name_filter=None):
+        """id のエントリーを返す。name_filter に合わない場合は None"""
+        condition, params = self._name_condition(name_filter)
+        with self._lock:
+            row = self._conn.execute("SELECT " + ", ".join(self._columns) + " FROM ranking "
+                                     "WHERE id = ? AND " + condition,
+                                     (entry_id,) + params).fetchone()
+        return None if row is None else self._to_item(row)
+
+    def rank_of(self, entry_id, name_filter=None):
+        """name_filter に合うエントリーの中での順位 (0 始まり) を返す。"""
+        condition, params = self._name_condition(name_filter, table="r")
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM ranking AS r, ranking AS e "
+                                      "WHERE e.id = ? AND (r.f1_score > e.f1_score "
+                                      "OR (r.f1_score = e.f1_score AND r.id < e.id)) "
+                                      "AND " + condition,
+                                      (entry_id,) + params).fetchone()[0]
+
+    def _to_item(self, row):
+        item = dict(zip(self._columns, row))
+        # 以前の pickle と同じキーでも参照できるようにする
+        item["f1-score"] = item["f1_score"]
+        return item
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+    def migrate_pickle(self, path=legacy_pickle_path):
+        """以前の ranking.pickle があれば取り込み、名前を変えて残しておく。"""
+        if not os.path.exists(path):
+            return 0
+        with open(path, "rb") as f:
+            data = pickle.load(f)
+        created_at = datetime.datetime.today().isoformat()
+        rows = []
+        for item in data:
+            creator = item.get("model_creator")
+            rows.append((item["name"], item["f1-score"], item.get("model_file_name"),
+                         creator.to_json() if creator is not None else None, created_at))
+        # 途中で失敗したときに一部だけ取り込まれないように、１つのトランザクションで行う
+        with self._lock, self._conn:
+            self._conn.executemany("INSERT INTO ranking "
+                                   "(name, f1_score, model_file_name, model_creator, created_at) "
+                                   "VALUES (?, ?, ?, ?, ?)", rows)
+        os.replace(path, path + ".migrated")
+        return len(data)
@@ -3,48 +3,75 @@ from PyQt5.QtGui import *
 from PyQt5.QtWidgets import *
 import threading
 import datetime
-import pickle
 from one_line_info import *
+from ranking_store import RankingStore
+from model_store import ModelStore
+from model_creator import ModelCreator
 
 
 class RankingData:
     def __init__(self):
+        self._store = RankingStore()
+        self._model_store = ModelStore()
         try:
-            f = open("./ranking_data/ranking.pickle", "rb")
-            self._data = pickle.load(f)
-        except:
-            self._data = list()
+            self._store.migrate_pickle()
+        except Exception as e:
+            print("ranking.pickle を読み込めませんでした。" + str(e))
 
         self.update_notify_func = None
 
     def insert(self, name: str, f1_score: float, mnist_model):
-        item = dict()
         d = datetime.datetime.today()
-        model_file_name = "./ranking_data/"\
-                          + name + "_"\
-                          + d.strftime("%Y-%m-%d_%H-%M-%S")\
-                          + ".hdf5"
-        item.update({"name": name,
-                     "f1-score": f1_score,
-                     "model_file_name": model_file_name,
-                     "model_creator": mnist_model.model_creator,
-                     })
-        self._data.append(item)
-        print(self._data)
+        model_creator_json = mnist_model.model_creator.to_json()
+
+        # モデルは構造と重みを重複なく保存し、エントリーには参照だけを記録する
+        model_ref = None
+        stats = {}
+        try:
+            model_ref = self._model_store.put(model_creator_json, mnist_model.get_weights(), stats)
+        except Exception as e:
+            print("モデルは保存されませんでした。" + str(e))
+        else:
+            global_one_line_info.send("モデルを保存しました。({:.1f} KB のうち {:.1f} KB を書き込み / {:.3f} 秒)"
+                                      .format(stats["bytes"] / 2 ** 10,
+                                              stats["written_bytes"] / 2 ** 10,
+                                              stats["seconds"]))
+
+        # 構造は ModelStore にあるので、保存できなかったときだけエントリーに記録する
+        entry_id = self._store.insert(name, f1_score, None,
+                                      model_creator_json if model_ref is None else None,
+                                      d.isoformat(), model_ref)
 
         if self.update_notify_func is not None:
-            self.update_notify_func()
+            self.update_notify_func(entry_id)
 
-        try:
-            mnist_model.save(model_file_name)
-        except:
-            print(model_file_name + "は保存されませんでした。")
+    def count(self, name_filter=None):
+        return self._store.count(name_filter)
 
-        with open("./ranking_data/ranking.pickle", "wb") as f:
-            pickle.dump(self._data, f)
+    def get_sorted_data(self, limit=-1, offset=0, name_filter=None):
+        """スコアの高い順に返す。limit が負の場合はすべて返す。"""
+        return self._store.top(limit, offset, name_filter)
 
-    def get_sorted_data(self):
-        return sorted(self._data, key=lambda item: - item['f1-score'])
+    def get(self, entry_id, name_filter=None):
+        return self._store.get(entry_id, name_filter)
+
+    def rank_of(self, entry_id, name_filter=None):
+        return self._store.rank_of(entry_id, name_filter)
+
+    def load_model(self, item):
+        """
+        エントリーのモデルを復元する。
+
+        :return: (keras のモデル, ModelCreator)
+        """
+        if item.get('model_ref') is not None:
+            return self._model_store.load_model(item['model_ref'])
+        # ModelStore を使う前に登録されたエントリー
+        if item.get('model_file_name') is None or item.get('model_creator') is None:
+            raise RuntimeError("このエントリーのモデルは保存されていません。")
+        from keras.models import load_model
+        model = load_model(item['model_file_name'])
+        return model, ModelCreator.from_json(item['model_creator'])
 
     def set_update_notify_func(self, func):
         self.update_notify_func = func
@@ -131,6 +158,91 @@ class RankingRegisterDialog(QDialog):
         self.register_func = func
 
 
+class RankingTableModel(QAbstractTableModel):
+    """
+    ランキングを表示するためのモデル
+
+    行はスクロールに合わせて page_size 件ずつ RankingData から読み込む。
+    登録されたときは、その行だけを挿入する。
+    """
+    page_size = 200
+
+    def __init__(self, ranking_data, parent=None):
+        super(RankingTableModel, self).__init__(parent)
+        self.ranking_data = ranking_data
+        self.name_filter = ""
+        self._rows = []
+        self._total = self.ranking_data.count()
+
+    def rowCount(self, parent=QModelIndex()):
+        if parent.isValid():
+            return 0
+        return len(self._rows)
+
+    def columnCount(self, parent=QModelIndex()):
+        if parent.isValid():
+            return 0
+        return 2
+
+    def data(self, index, role=Qt.DisplayRole):
+        if not index.isValid() or role != Qt.DisplayRole:
+            return None
+        item = self._rows[index.row()]
+        if index.column() == 0:
+            return item['name']
+        return str(item['f1-score'])
+
+    def flags(self, index):
+        return Qt.ItemIsEnabled
+
+    def item(self, row):
+        return self._rows[row]
+
+    def headerData(self, section, orientation, role=Qt.DisplayRole):
+        if role != Qt.DisplayRole:
+            return None
+        if orientation == Qt.Horizontal:
+            return ["名前", "スコア"][section]
+        return str(section + 1)
+
+    def canFetchMore(self, parent=QModelIndex()):
+        if parent.isValid():
+            return False
+        return len(self._rows) < self._total
+
+    def fetchMore(self, parent=QModelIndex()):
+        if parent.isValid():
+            return
+        rows = self.ranking_data.get_sorted_data(self.page_size, len(self._rows),
+                                                 self.name_filter)
+        if not rows:
+            self._total = len(self._rows)
+            return
+        self.beginInsertRows(QModelIndex(), len(self._rows), len(self._rows) + len(rows) - 1)
+        self._rows.extend(rows)
+        self.endInsertRows()
+
+    def set_name_filter(self, name_filter):
+        self.beginResetModel()
+        self.name_filter = name_filter
+        self._rows = []
+        self._total = self.ranking_data.count(name_filter)
+        self.endResetModel()
+
+    def entry_inserted(self, entry_id):
+        item = self.ranking_data.get(entry_id, self.name_filter)
+        if item is None:
+            return
+        loaded_all = len(self._rows) == self._total
+        self._total += 1
+        rank = self.ranking_data.rank_of(entry_id, self.name_filter)
+        # まだ読み込んでいない範囲なら、スクロールしたときに読み込まれる
+        if rank < len(self._rows) or (rank == len(self._rows) and loaded_all):
+            self.beginInsertRows(QModelIndex(), rank, rank)
+            self._rows.insert(rank, item)
+            self.endInsertRows()
+
+
 class RankingWidget(QWidget):
     def __init__(self, mnist_model, parent=None):
         super(RankingWidget, self).__init__()
@@ -148,26 +260,39 @@ class RankingWidget(QWidget):
         self.register_btn = QPushButton("登録", self)
         self.register_btn.clicked.connect(self.register_dialog.show_dialog)
 
-        self.ranking_table = QTableWidget(self)
-        self.ranking_table.setColumnCount(2)
-        self.ranking_table.setHorizontalHeaderLabels(["名前", "スコア"])
+        self.search_box = QLineEdit(self)
+        self.search_box.setPlaceholderText("名前で検索")
+        self.search_box.textChanged.connect(self.update_filter)
 
-        self.update_ranking()
-        self.ranking_data.set_update_notify_func(self.update_ranking)
+        self.ranking_model = RankingTableModel(self.ranking_data, self)
+        self.ranking_table = QTableView(self)
+        self.ranking_table.setModel(self.ranking_model)
+
+        self.ranking_table.doubleClicked.connect(self.load_entry_model)
+
+        self.ranking_data.set_update_notify_func(self.ranking_model.entry_inserted)
+        self.mnist_model = mnist_model
 
     def resizeEvent(self, QResizeEvent):
         self.register_btn.move(self.width() * 0.1, self.height() * 0.1)
 
+        self.search_box.move(self.width() * 0.3, self.height() * 0.05)
+        self.search_box.resize(self.width() * 0.6, self.height() * 0.04)
+
         self.ranking_table.move(self.width() * 0.3, self.height() * 0.1)
         self.ranking_table.resize(self.width() * 0.6, self.height() * 0.8)
 
-    def update_ranking(self):
-        ranking = self.ranking_data.get_sorted_data()
-        self.ranking_table.setRowCount(len(ranking))
-        for i, item in enumerate(ranking):
-            item_name = QTableWidgetItem(item['name'])
-            item_name.setFlags(Qt.ItemIsEnabled)
-            item_score = QTableWidgetItem(str(item['f1-score']))
-            item_score.setFlags(Qt.ItemIsEnabled)
-            self.ranking_table.setItem(i, 0, item_name)
-            self.ranking_table.setItem(i, 1, item_score)
+    def update_filter(self, text):
+        self.ranking_model.set_name_filter(text)
+
+    def load_entry_model(self, index):
+        """ダブルクリックしたエントリーのモデルをロードする"""
+        item = self.ranking_model.item(index.row())
+        try:
+            if self.mnist_model.is_learning():
+                raise RuntimeError("学習中です。")
+            model, model_creator = self.ranking_data.load_model(item)
+            self.mnist_model.set_model(model, model_creator)
+            global_one_line_info.send(item['name'] + " のモデルをロードしました。")
+        except (RuntimeError, OSError) as e:
+            global_one_line_info.send(str(e))
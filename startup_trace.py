@@ -0,0 +1,64 @@
+import contextlib
+import json
+import threading
+import time
+
+default_trace_path = './startup_trace.json'
+
+# 最初に import された時刻を起動の時刻とみなす。mnist_gui では最初に import する
+_origin = time.perf_counter()
+
+
+class StartupTrace:
+    """
+    起動の各段階にかかった時間を記録するクラス
+
+    時刻は起動の時刻からの秒数で記録する。別のスレッドの段階も同じトレースに記録できる。
+    """
+    def __init__(self, origin=None):
+        self.origin = _origin if origin is None else origin
+        self.phases = []
+        self._lock = threading.Lock()
+
+    def add(self, name, begin, end=None):
+        """perf_counter の時刻で begin から end (省略したら今) までを記録する。"""
+        if end is None:
+            end = time.perf_counter()
+        with self._lock:
+            self.phases.append({"name": name,
+                                "thread": threading.current_thread().name,
+                                "start": begin - self.origin,
+                                "seconds": end - begin})
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        begin = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, begin)
+
+    def mark(self, name):
+        """時間のかからない出来事 (ウィンドウの表示など) を記録する。"""
+        now = time.perf_counter()
+        self.add(name, now, now)
+
+    def to_dict(self):
+        with self._lock:
+            phases = list(self.phases)
+        total = max((p["start"] + p["seconds"] for p in phases), default=0.0)
+        return {"total": total, "phases": phases}
+
+    def format(self):
+        lines = ["startup trace"]
+        for p in self.to_dict()["phases"]:
+            lines.append("{:7.3f} s +{:.3f} s {} ({})".format(p["start"], p["seconds"],
+                                                              p["name"], p["thread"]))
+        return "\n".join(lines)
+
+    def save(self, path=default_trace_path):
+        with open(path, "w") as f:
+            json.dump(self.to_dict(), f, indent=2)
+
+
+startup_trace = StartupTrace()
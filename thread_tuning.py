@@ -0,0 +1,217 @@
+"""
+TensorFlow のスレッド数 (intra_op と inter_op) を、このマシンと今のモデルに合わせて決めるモジュール
+
+学習と予測は別のグラフとセッションで行い、スレッド数もそれぞれに設定する。
+予測のスレッド数は、選んだ設定で学習を続けて CPU を使い切っている間に予測の時間を計って決める。
+結果は JSON に保存し、CPU の数が変わらなければ次からの起動では計測しない。
+"""
+import contextlib
+import json
+import os
+import threading
+import time
+
+import numpy as np
+
+default_profile_path = './thread_profile.json'
+# 学習の速さを計るバッチの数と、予測の時間を計る回数
+default_train_steps = 5
+default_predict_repeat = 50
+
+
+def cpu_count():
+    return os.cpu_count() or 1
+
+
+def default_profile():
+    """計測する前に使うスレッド数"""
+    n = cpu_count()
+    return {"cpu_count": n,
+            "tuned": False,
+            "training": {"intra_op": n, "inter_op": 2},
+            "inference": {"intra_op": 1, "inter_op": 1}}
+
+
+def _unique(candidates, n):
+    result = []
+    for intra_op, inter_op in candidates:
+        threads = {"intra_op": min(max(intra_op, 1), n), "inter_op": min(max(inter_op, 1), n)}
+        if threads not in result:
+            result.append(threads)
+    return result
+
+
+def training_candidates(n):
+    return _unique([(n, 2), (n, 1), (n - 1, 2), (n // 2, 2)], n)
+
+
+def inference_candidates(n):
+    # 予測は１枚ずつなので、学習とコアを取り合わない少ないスレッド数を試す
+    return _unique([(1, 1), (2, 1), (n // 4, 1), (n // 2, 1)], n)
+
+
+def session_config(threads):
+    import tensorflow as tf
+    return tf.ConfigProto(intra_op_parallelism_threads=threads["intra_op"],
+                          inter_op_parallelism_threads=threads["inter_op"])
+
+
+def format_profile(profile):
+    text = "threads: training {}/{}, inference {}/{} (intra_op/inter_op)".format(
+        profile["training"]["intra_op"], profile["training"]["inter_op"],
+        profile["inference"]["intra_op"], profile["inference"]["inter_op"])
+    if not profile["tuned"]:
+        text += " (not tuned)"
+    return text
+
+
+class IsolatedSession:
+    """
+    専用のグラフとセッション
+
+    既定のグラフと keras のセッションとは別に、スレッド数を設定できる。
+    """
+    def __init__(self, threads):
+        import tensorflow as tf
+        self.threads = dict(threads)
+        self.graph = tf.Graph()
+        self.session = tf.Session(graph=self.graph, config=session_config(threads))
+
+    @contextlib.contextmanager
+    def as_default(self):
+        """keras がこのグラフとセッションを使うようにする。使うスレッドごとに入る。"""
+        with self.graph.as_default(), self.session.as_default():
+            yield
+
+    def close(self):
+        self.session.close()
+
+
+def _measure_training(build_model, threads, x, y, steps):
+    """:return: 1 秒あたりに学習できたサンプル数"""
+    sandbox = IsolatedSession(threads)
+    try:
+        with sandbox.as_default():
+            model = build_model()
+            # 最初のバッチは関数の構築で遅いので数えない
+            model.train_on_batch(x, y)
+            begin = time.perf_counter()
+            for _ in range(steps):
+                model.train_on_batch(x, y)
+            seconds = (time.perf_counter() - begin) / steps
+    finally:
+        sandbox.close()
+    return len(x) / seconds
+
+
+def _measure_inference(build_model, threads, image, repeat):
+    """:return: １枚の予測にかかった時間 (ミリ秒) の中央値と 95 パーセンタイル"""
+    sandbox = IsolatedSession(threads)
+    try:
+        with sandbox.as_default():
+            model = build_model()
+            model.predict(image)
+            seconds = []
+            for _ in range(repeat):
+                begin = time.perf_counter()
+                model.predict(image)
+                seconds.append(time.perf_counter() - begin)
+    finally:
+        sandbox.close()
+    return {"median_ms": float(np.median(seconds)) * 1000,
+            "p95_ms": float(np.percentile(seconds, 95)) * 1000}
+
+
+class _BackgroundTraining(threading.Thread):
+    """予測の時間を計る間、CPU を使い切るように学習を続けるスレッド"""
+    def __init__(self, build_model, threads, x, y):
+        super(_BackgroundTraining, self).__init__(daemon=True)
+        self.build_model = build_model
+        self.threads = threads
+        self.x = x
+        self.y = y
+        self.started = threading.Event()
+        self._stopping = threading.Event()
+
+    def stop(self):
+        self._stopping.set()
+        self.join()
+
+    def run(self):
+        sandbox = IsolatedSession(self.threads)
+        try:
+            with sandbox.as_default():
+                model = self.build_model()
+                model.train_on_batch(self.x, self.y)
+                self.started.set()
+                while not self._stopping.is_set():
+                    model.train_on_batch(self.x, self.y)
+        finally:
+            self.started.set()
+            sandbox.close()
+
+
+def tune(build_model, batch_size, steps=default_train_steps, repeat=default_predict_repeat,
+         log=print):
+    """
+    学習と予測のスレッド数の候補を試して、一番よいものを選ぶ。
+
+    学習は 1 秒あたりのサンプル数が一番多い設定を選ぶ。
+    予測はその設定で学習している間に計り、95 パーセンタイルの時間が一番短い設定を選ぶ。
+
+    :param build_model: 今のグラフにコンパイルしたモデルを作る関数。候補ごとに別のグラフで呼ぶ
+    :return: save できる dict
+    """
+    n = cpu_count()
+    rng = np.random.RandomState(0)
+    x = rng.uniform(0, 255, (batch_size, 28, 28, 1)).astype(np.float32)
+    y = rng.randint(0, 10, batch_size)
+    measurements = []
+
+    for threads in training_candidates(n):
+        samples_per_second = _measure_training(build_model, threads, x, y, steps)
+        measurements.append({"path": "training", "threads": threads,
+                             "samples_per_second": samples_per_second})
+        log("training {}/{}: {:.0f} samples/s".format(threads["intra_op"], threads["inter_op"],
+                                                      samples_per_second))
+    training = max((m for m in measurements if m["path"] == "training"),
+                   key=lambda m: m["samples_per_second"])["threads"]
+
+    background = _BackgroundTraining(build_model, training, x, y)
+    background.start()
+    background.started.wait()
+    try:
+        for threads in inference_candidates(n):
+            latency = _measure_inference(build_model, threads, x[:1], repeat)
+            measurements.append(dict(latency, path="inference", threads=threads))
+            log("inference {}/{} while training: {:.2f} ms (p95 {:.2f} ms)".format(
+                threads["intra_op"], threads["inter_op"], latency["median_ms"], latency["p95_ms"]))
+    finally:
+        background.stop()
+    inference = min((m for m in measurements if m["path"] == "inference"),
+                    key=lambda m: m["p95_ms"])["threads"]
+
+    return {"cpu_count": n,
+            "tuned": True,
+            "batch_size": batch_size,
+            "created_at": time.time(),
+            "training": training,
+            "inference": inference,
+            "measurements": measurements}
+
+
+def save(profile, path=default_profile_path):
+    with open(path, "w") as f:
+        json.dump(profile, f, indent=2)
+
+
+def load(path=default_profile_path):
+    """:return: 保存したプロファイル。ファイルがないか、CPU の数が変わっていれば None"""
+    try:
+        with open(path) as f:
+            profile = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if profile.get("cpu_count") != cpu_count():
+        return None
+    return profile
@@ -0,0 +1,124 @@
+"""
+学習の途中経過 (重みと最適化の状態) をチェックポイントとして保存するモジュール
+
+書き込みは CheckpointWriter のスレッドで行うので、学習は書き込みを待たない。
+ファイルは一時ファイルに書いてから os.replace で置き換えるので、途中で落ちても壊れない。
+"""
+import io
+import json
+import os
+import threading
+import time
+
+import numpy as np
+
+default_checkpoint_path = './checkpoints/latest.npz'
+
+
+def architecture_signature(model):
+    """
+    層の種類と重みの形の文字列。同じ構造なら、作り直して層の名前が変わっても同じになる。
+
+    形は変数から読むので、重みをセッションから取り出さない。
+    """
+    from keras import backend as K
+    layers = [[layer.__class__.__name__, [list(K.int_shape(w)) for w in layer.weights]]
+              for layer in model.layers]
+    optimizer = getattr(model, 'optimizer', None)
+    return json.dumps({"layers": layers,
+                       "optimizer": None if optimizer is None else optimizer.__class__.__name__})
+
+
+def save(checkpoint, path=default_checkpoint_path):
+    """
+    :param checkpoint: {"meta": JSON にできる dict, "weights": [...], "optimizer": [...]}
+    """
+    arrays = {"meta": np.array(json.dumps(checkpoint["meta"]))}
+    for prefix in ("weights", "optimizer"):
+        for i, w in enumerate(checkpoint[prefix]):
+            arrays["{}_{}".format(prefix, i)] = w
+    buffer = io.BytesIO()
+    np.savez(buffer, **arrays)
+
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(buffer.getvalue())
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+def load_meta(path=default_checkpoint_path):
+    """:return: save に渡した meta だけを読み込む。重みは読まない。ファイルがなければ None"""
+    if not os.path.exists(path):
+        return None
+    with np.load(path, allow_pickle=False) as data:
+        return json.loads(str(data["meta"]))
+
+
+def load(path=default_checkpoint_path):
+    """:return: save に渡した形の dict。ファイルがなければ None"""
+    if not os.path.exists(path):
+        return None
+    with np.load(path, allow_pickle=False) as data:
+        meta = json.loads(str(data["meta"]))
+        checkpoint = {"meta": meta}
+        for prefix in ("weights", "optimizer"):
+            checkpoint[prefix] = [data["{}_{}".format(prefix, i)]
+                                  for i in range(meta["num_" + prefix])]
+    return checkpoint
+
+
+class CheckpointWriter(threading.Thread):
+    """
+    チェックポイントを書き込むスレッド
+
+    書き込みが追いつかないときは、まだ書いていない古いチェックポイントを捨てて最新のものだけを書く。
+    """
+    def __init__(self, path=default_checkpoint_path):
+        super(CheckpointWriter, self).__init__(daemon=True)
+        self.path = path
+        self._cond = threading.Condition()
+        self._pending = None
+        self._writing = False
+        self.num_written = 0
+        self.num_dropped = 0
+        self.last_write_seconds = None
+        self.last_error = None
+
+    def submit(self, checkpoint):
+        checkpoint["meta"]["num_weights"] = len(checkpoint["weights"])
+        checkpoint["meta"]["num_optimizer"] = len(checkpoint["optimizer"])
+        with self._cond:
+            if self._pending is not None:
+                self.num_dropped += 1
+            self._pending = checkpoint
+            self._cond.notify_all()
+
+    def flush(self, timeout=None):
+        """渡したチェックポイントがすべて書き込まれるまで待つ。"""
+        with self._cond:
+            return self._cond.wait_for(lambda: self._pending is None and not self._writing,
+                                       timeout)
+
+    def run(self):
+        while True:
+            with self._cond:
+                self._cond.wait_for(lambda: self._pending is not None)
+                checkpoint, self._pending = self._pending, None
+                self._writing = True
+            try:
+                begin = time.perf_counter()
+                save(checkpoint, self.path)
+                self.last_write_seconds = time.perf_counter() - begin
+                self.num_written += 1
+            except Exception as e:
+                # スレッドが終わると flush が返らなくなるので、どんなエラーでも記録して続ける
+                self.last_error = e
+            finally:
+                with self._cond:
+                    self._writing = False
+                    self._cond.notify_all()
@@ -0,0 +1,108 @@
+import threading
+import time
+
+import numpy as np
+
+default_capacity = 256
+# GUI に送る更新の最大の頻度 (回/秒)
+default_max_rate_hz = 10.0
+
+
+def _mean(values):
+    values = values[~np.isnan(values)]
+    return float(values.mean()) if len(values) else None
+
+
+class TrainingTelemetry:
+    """
+    学習のバッチごとの記録を、固定サイズのリングバッファに保持するクラス
+
+    record は学習のスレッドからバッチごとに呼ぶ。記録するだけなので軽い。
+    summary は直近のバッチをまとめた値を返し、due は max_rate_hz を超えないように更新の時期を知らせる。
+    """
+    _fields = ("time", "loss", "accuracy", "samples")
+
+    def __init__(self, capacity=default_capacity, max_rate_hz=default_max_rate_hz):
+        self.capacity = capacity
+        self.max_rate_hz = max_rate_hz
+        self._lock = threading.Lock()
+        self._buffer = np.zeros((capacity, len(self._fields)), dtype=np.float64)
+        self.reset(0)
+
+    def reset(self, num_batch, time_budget_seconds=None):
+        """
+        学習を始めるときに呼ぶ。
+
+        :param time_budget_seconds: 学習時間の上限。指定すると、全部のバッチより先に時間を使い切る場合は
+                                    進捗と残り時間を経過時間から計算する
+        """
+        with self._lock:
+            self.num_batch = num_batch
+            self.time_budget_seconds = time_budget_seconds
+            self.count = 0
+            self.begin = time.perf_counter()
+            self._last_delivered = 0.0
+            self._buffer[:] = np.nan
+
+    def record(self, count, logs):
+        """count 個目のバッチの結果を記録する。"""
+        accuracy = logs.get("acc", logs.get("accuracy", np.nan))
+        with self._lock:
+            self.count = count
+            self._buffer[count % self.capacity] = (time.perf_counter(), logs.get("loss", np.nan),
+                                                   accuracy, logs.get("size", 0))
+
+    def due(self):
+        """前回 GUI に送ってから 1 / max_rate_hz 秒以上経っていれば True"""
+        now = time.perf_counter()
+        with self._lock:
+            if self.count < self.num_batch and now - self._last_delivered < 1 / self.max_rate_hz:
+                return False
+            self._last_delivered = now
+            return True
+
+    def summary(self):
+        """
+        :return: {"count", "num_batch", "percent", "loss", "accuracy",
+                  "samples_per_second", "eta_seconds"}
+                 loss と accuracy はバッファにある直近のバッチの平均
+        """
+        with self._lock:
+            count, num_batch = self.count, self.num_batch
+            rows = self._buffer[~np.isnan(self._buffer[:, 0])]
+            rows = rows[np.argsort(rows[:, 0])]
+            begin = self.begin
+            time_budget_seconds = self.time_budget_seconds
+        samples_per_second = 0.0
+        if len(rows) >= 2 and rows[-1, 0] > rows[0, 0]:
+            # 最初のバッチは、それより前の時刻がないので数えない
+            samples_per_second = rows[1:, 3].sum() / (rows[-1, 0] - rows[0, 0])
+        elapsed = time.perf_counter() - begin
+        percent = count / num_batch * 100 if num_batch else 0.0
+        eta_seconds = None
+        if count > 0:
+            eta_seconds = elapsed / count * (num_batch - count)
+        if time_budget_seconds:
+            budget_eta_seconds = max(time_budget_seconds - elapsed, 0.0)
+            if eta_seconds is None or budget_eta_seconds < eta_seconds:
+                eta_seconds = budget_eta_seconds
+                percent = min(elapsed / time_budget_seconds * 100, 100.0)
+        return {"count": count,
+                "num_batch": num_batch,
+                "percent": percent,
+                "loss": _mean(rows[:, 1]),
+                "accuracy": _mean(rows[:, 2]),
+                "samples_per_second": float(samples_per_second),
+                "eta_seconds": eta_seconds}
+
+
+def format_summary(summary):
+    text = "batch {}/{}".format(summary["count"], summary["num_batch"])
+    if summary["loss"] is not None:
+        text += " / loss {:.4f}".format(summary["loss"])
+    if summary["accuracy"] is not None:
+        text += " / acc {:.4f}".format(summary["accuracy"])
+    text += " / {:.0f} samples/s".format(summary["samples_per_second"])
+    if summary["eta_seconds"] is not None:
+        text += " / ETA {:.0f} s".format(summary["eta_seconds"])
+    return text